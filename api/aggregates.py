@@ -0,0 +1,181 @@
+"""Incrementally maintained consent counters.
+
+Every write or delete of a user's preferences applies the difference between
+the old and new preferences to a handful of counter rows in SQLite, so
+"how many users have analytics_consent enabled" is answered without touching
+user records. ``python api/aggregates.py rebuild`` recomputes the counters
+from the store in parallel (e.g. after a bulk migration).
+"""
+import argparse
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from codec import PREFERENCE_FLAGS
+
+USERS_COUNTER = "users"
+
+
+def preference_counters(preferences: Optional[dict]) -> Dict[str, int]:
+    """Counters contributed by a single user's preferences"""
+    if preferences is None:
+        return {}
+    counters = {USERS_COUNTER: 1}
+    for name in PREFERENCE_FLAGS:
+        if preferences.get(name):
+            counters[f"flag:{name}"] = 1
+    counters[f"cookie_preference:{preferences.get('cookie_preference')}"] = 1
+    return counters
+
+
+def preference_diff(old: Optional[dict], new: Optional[dict]) -> Dict[str, int]:
+    deltas = dict(preference_counters(new))
+    for name, value in preference_counters(old).items():
+        deltas[name] = deltas.get(name, 0) - value
+    return {name: delta for name, delta in deltas.items() if delta}
+
+
+class ConsentAggregates:
+    """Counter rows in a small SQLite database shared by all workers"""
+
+    def __init__(self, path="data/aggregates.db"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS consent_counters (
+                name TEXT PRIMARY KEY,
+                count INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def apply(self, deltas: Dict[str, int]) -> None:
+        if not deltas:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                """INSERT INTO consent_counters (name, count, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    count = count + excluded.count, updated_at = excluded.updated_at""",
+                [(name, delta, now) for name, delta in deltas.items()],
+            )
+            self._conn.commit()
+
+    def record_change(self, old: Optional[dict], new: Optional[dict]) -> None:
+        self.apply(preference_diff(old, new))
+
+    def record_changes(self, changes: Iterable[tuple]) -> None:
+        """Apply many (old, new) pairs in one transaction"""
+        total = {}
+        for old, new in changes:
+            for name, delta in preference_diff(old, new).items():
+                total[name] = total.get(name, 0) + delta
+        self.apply(total)
+
+    def replace(self, counters: Dict[str, int]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM consent_counters")
+            self._conn.executemany(
+                "INSERT INTO consent_counters (name, count, updated_at) VALUES (?, ?, ?)",
+                [(name, count, now) for name, count in counters.items()],
+            )
+            self._conn.commit()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, count, updated_at FROM consent_counters"
+            ).fetchall()
+        result = {
+            USERS_COUNTER: 0,
+            "flags": {name: 0 for name in PREFERENCE_FLAGS},
+            "cookie_preference": {},
+            "updated_at": max((row[2] for row in rows), default=None),
+        }
+        for name, count, _ in rows:
+            if name == USERS_COUNTER:
+                result[USERS_COUNTER] = count
+            elif name.startswith("flag:"):
+                result["flags"][name[5:]] = count
+            elif name.startswith("cookie_preference:") and count:
+                result["cookie_preference"][name[18:]] = count
+        return result
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+_fernet = None
+
+
+def _init_worker(keys: List[bytes]) -> None:
+    global _fernet
+    from rotation import build_multifernet
+    _fernet = build_multifernet(keys)
+
+
+def _count_blobs(blobs: List[bytes]) -> Dict[str, int]:
+    from codec import decode_user_record
+    totals = {}
+    for blob in blobs:
+        preferences = decode_user_record(_fernet.decrypt(blob))["preferences"]
+        for name, value in preference_counters(preferences).items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def rebuild(store, keys: List[bytes], workers: Optional[int] = None, chunk_size: int = 1000) -> Dict[str, int]:
+    """Recount every record, decrypting chunks of records in worker processes"""
+    def chunks():
+        chunk = []
+        for _, blob in store.iter_records():
+            chunk.append(blob)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    totals = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(keys,)) as pool:
+        for partial in pool.map(_count_blobs, chunks()):
+            for name, value in partial.items():
+                totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+if __name__ == "__main__":
+    import json
+    import os
+    from rotation import load_keys_from_env
+    from settings import load_env_file
+    from storage import create_user_store
+
+    load_env_file()
+
+    parser = argparse.ArgumentParser(description="Consent aggregate counters")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Recompute counters from the user store")
+    rebuild_parser.add_argument("--db", default=os.getenv("AGGREGATES_DB_PATH", "data/aggregates.db"))
+    rebuild_parser.add_argument("--workers", type=int, default=None)
+    rebuild_parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    keys = load_keys_from_env()
+    if not keys:
+        parser.error("Set ENCRYPTION_KEYS or ENCRYPTION_KEY")
+    start = time.time()
+    counters = rebuild(create_user_store(), keys, workers=args.workers, chunk_size=args.chunk_size)
+    aggregates = ConsentAggregates(args.db)
+    aggregates.replace(counters)
+    print(json.dumps(aggregates.snapshot(), indent=2))
+    print(f"Rebuilt consent counters in {time.time() - start:.2f}s")
@@ -0,0 +1,216 @@
+"""User credentials and bcrypt password checks off the event loop.
+
+bcrypt is deliberately slow (~200 ms of CPU at the default cost), so
+PasswordHasher runs it in a bounded process pool. When more checks are
+pending than the pool can absorb, new logins are shed with AuthOverloaded
+instead of queueing without limit. Workers are started from a forkserver
+(the API process already runs threads by then), and a pool broken by a
+dead worker is replaced on the next check.
+"""
+import argparse
+import asyncio
+import getpass
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Optional, Tuple
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+_pwd_context = None
+_dummy_hash = None
+
+
+def _context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(
+            schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS
+        )
+    return _pwd_context
+
+
+def hash_password(password: str) -> str:
+    return _context().hash(password)
+
+
+def verify_password(password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """Check a password; returns (ok, new hash if the stored one needs upgrading).
+
+    Unknown users are checked against a dummy hash so they take as long as
+    known ones and can't be told apart by timing.
+    """
+    global _dummy_hash
+    if hashed is None:
+        if _dummy_hash is None:
+            _dummy_hash = hash_password("dummy-password")
+        _context().verify(password, _dummy_hash)
+        return False, None
+    return _context().verify_and_update(password, hashed)
+
+
+class AuthOverloaded(Exception):
+    """Raised when too many password checks are already pending"""
+
+
+class PasswordHasher:
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None, mode="process"):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.mode = mode
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.pending = 0
+        self.shed = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context(
+                    "forkserver" if "forkserver" in methods else "spawn"
+                )
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, func, *args):
+        if self.mode == "inline":
+            return func(*args)
+        if self.pending >= self.max_pending:
+            self.shed += 1
+            raise AuthOverloaded()
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            pool = self._executor()
+            try:
+                return await loop.run_in_executor(pool, func, *args)
+            except BrokenProcessPool:
+                # A worker died (OOM kill, crash): start a new pool and retry once
+                self._discard(pool)
+                return await loop.run_in_executor(self._executor(), func, *args)
+        finally:
+            self.pending -= 1
+
+    async def verify(self, password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+        return await self._run(verify_password, password, hashed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "shed": self.shed,
+        }
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+class CredentialStore:
+    """bcrypt hashes and granted scopes per user, in SQLite"""
+
+    def __init__(self, path="data/credentials.db"):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS credentials (
+                email TEXT PRIMARY KEY,
+                password_hash TEXT NOT NULL,
+                scopes TEXT NOT NULL DEFAULT '',
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def get(self, email: str) -> Optional[Tuple[str, frozenset]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT password_hash, scopes FROM credentials WHERE email = ?", (email,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], frozenset(row[1].split())
+
+    def set(self, email: str, password_hash: str, scopes=()) -> None:
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO credentials (email, password_hash, scopes, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(email) DO UPDATE SET password_hash = excluded.password_hash,
+                    scopes = excluded.scopes, updated_at = excluded.updated_at""",
+                (email, password_hash, " ".join(sorted(scopes)), time.time()),
+            )
+            self._conn.commit()
+
+    def set_scopes(self, email: str, scopes) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE credentials SET scopes = ?, updated_at = ? WHERE email = ?",
+                (" ".join(sorted(scopes)), time.time(), email),
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def update_hash(self, email: str, password_hash: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE credentials SET password_hash = ?, updated_at = ? WHERE email = ?",
+                (password_hash, time.time(), email),
+            )
+            self._conn.commit()
+
+    def delete(self, email: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM credentials WHERE email = ?", (email,))
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage API user credentials")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add-user", help="Create or reset a user's password")
+    add_parser.add_argument("email")
+    add_parser.add_argument("--admin", action="store_true", help="Allow the admin scope")
+    remove_parser = subparsers.add_parser("remove-user", help="Delete a user's credentials")
+    remove_parser.add_argument("email")
+    admin_parser = subparsers.add_parser("set-admin", help="Allow or (with --revoke) deny the admin scope")
+    admin_parser.add_argument("email")
+    admin_parser.add_argument("--revoke", action="store_true")
+    parser.add_argument("--db", default=os.getenv("CREDENTIALS_DB_PATH", "data/credentials.db"))
+    args = parser.parse_args()
+
+    store = CredentialStore(args.db)
+    if args.command == "add-user":
+        password = getpass.getpass(f"Password for {args.email}: ")
+        if password != getpass.getpass("Repeat password: "):
+            parser.error("Passwords do not match")
+        store.set(args.email, hash_password(password), ["admin"] if args.admin else [])
+        print(f"Saved credentials for {args.email}")
+    elif args.command == "remove-user":
+        print("Removed" if store.delete(args.email) else "No such user")
+    elif args.command == "set-admin":
+        scopes = [] if args.revoke else ["admin"]
+        print("Updated" if store.set_scopes(args.email, scopes) else "No such user")
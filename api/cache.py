@@ -0,0 +1,151 @@
+"""Bounded in-process caches used by the API."""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+def approximate_size(value: Any) -> int:
+    """Rough deep size of dicts/lists/pydantic models in bytes"""
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        return sys.getsizeof(value) + approximate_size(vars(value))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            approximate_size(k) + approximate_size(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(approximate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a TTL, an entry limit and a memory cap.
+
+    Entries expire after ``ttl`` seconds (or a per-entry ``expires_at``),
+    the least recently used entry is evicted once ``max_entries`` or
+    ``max_bytes`` is exceeded. The cache is per process; with several
+    workers each one holds its own copy.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        ttl: Optional[float] = 300.0,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = approximate_size,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Like get, without touching the LRU order or the hit counters"""
+        with self._lock:
+            entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.monotonic()):
+            return None
+        return entry[0]
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        expires_at: Optional[float] = None,
+        generation: Optional[int] = None,
+    ) -> None:
+        """Store a value; ``expires_at`` is a time.monotonic() deadline.
+
+        Pass the ``generation`` read before loading the value to skip the
+        store if any invalidation raced with the load.
+        """
+        if not self.enabled:
+            return
+        if self.ttl is not None:
+            ttl_deadline = time.monotonic() + self.ttl
+            expires_at = ttl_deadline if expires_at is None else min(expires_at, ttl_deadline)
+        size = self.sizeof(key) + self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, expires_at, size)
+            self.current_bytes += size
+            while len(self._data) > self.max_entries or (
+                self.max_bytes and self.current_bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            self.generation += 1
+            if key in self._data:
+                self._remove(key)
+                self.invalidations += 1
+                return True
+            return False
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, size = self._data.pop(key)
+        self.current_bytes -= size
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
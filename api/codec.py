@@ -0,0 +1,140 @@
+"""Compact binary encoding for user records.
+
+Version 1 layout (big endian), encrypted in place of the JSON document:
+
+    B   format version (1; legacy JSON records start with "{")
+    H   preference flags, one bit per boolean in PREFERENCE_FLAGS order
+    B   cookie_preference code (COOKIE_PREFERENCE_CODES, 255 = inline string)
+    q   last_access, microseconds since the epoch (UTC)
+    q   last_consent_update, microseconds since the epoch (UTC)
+    H   email length, followed by the UTF-8 email
+    [H + utf-8]  cookie_preference string, only when the code is 255
+    I   active_sessions length, followed by its JSON (0 when empty)
+
+Changing UserPreferences fields requires a new version number here. The
+email and a custom cookie_preference are limited to MAX_STRING_BYTES each;
+encoding a longer one raises ValueError.
+"""
+import json
+import struct
+from datetime import datetime, timedelta
+
+FORMAT_VERSION = 1
+
+PREFERENCE_FLAGS = [
+    "marketing_emails",
+    "product_updates",
+    "security_alerts",
+    "analytics_consent",
+    "personalization",
+    "essential_cookies",
+    "analytics_cookies",
+    "marketing_cookies",
+    "functional_cookies",
+]
+
+# Field order of UserPreferences, used to rebuild the dict in the same shape
+PREFERENCE_FIELDS = PREFERENCE_FLAGS[:5] + ["cookie_preference"] + PREFERENCE_FLAGS[5:]
+_FLAG_BITS = {name: 1 << bit for bit, name in enumerate(PREFERENCE_FLAGS)}
+
+COOKIE_PREFERENCE_CODES = {
+    "essential": 0,
+    "functional": 1,
+    "analytics": 2,
+    "marketing": 3,
+    "all": 4,
+    "custom": 5,
+}
+COOKIE_PREFERENCE_NAMES = {code: name for name, code in COOKIE_PREFERENCE_CODES.items()}
+CUSTOM_CODE = 255
+
+_HEADER = struct.Struct(">BHBqqH")
+_SHORT_LENGTH = struct.Struct(">H")
+_LENGTH = struct.Struct(">I")
+_EPOCH = datetime(1970, 1, 1)
+MAX_STRING_BYTES = 0xFFFF
+
+
+def _to_micros(value) -> int:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(micros: int) -> str:
+    return (_EPOCH + timedelta(0, 0, micros)).isoformat()
+
+
+def _short_string(name: str, value: str) -> bytes:
+    encoded = value.encode()
+    if len(encoded) > MAX_STRING_BYTES:
+        raise ValueError(f"{name} is longer than {MAX_STRING_BYTES} bytes")
+    return encoded
+
+
+def encode_user_record(record: dict) -> bytes:
+    preferences = record["preferences"]
+    flags = 0
+    for name, bit in _FLAG_BITS.items():
+        if preferences[name]:
+            flags |= bit
+    cookie_preference = preferences["cookie_preference"]
+    code = COOKIE_PREFERENCE_CODES.get(cookie_preference, CUSTOM_CODE)
+    email = _short_string("email", record["email"])
+    parts = [
+        _HEADER.pack(
+            FORMAT_VERSION,
+            flags,
+            code,
+            _to_micros(record["last_access"]),
+            _to_micros(record["last_consent_update"]),
+            len(email),
+        ),
+        email,
+    ]
+    if code == CUSTOM_CODE:
+        custom = _short_string("cookie_preference", cookie_preference)
+        parts.append(_SHORT_LENGTH.pack(len(custom)) + custom)
+    sessions = record.get("active_sessions") or []
+    sessions_json = json.dumps(sessions, separators=(",", ":")).encode() if sessions else b""
+    parts.append(_LENGTH.pack(len(sessions_json)))
+    parts.append(sessions_json)
+    return b"".join(parts)
+
+
+def decode_user_record(data: bytes) -> dict:
+    """Decode a compact record, or a legacy JSON one"""
+    if data[:1] == b"{":
+        return json.loads(data)
+    version, flags, code, last_access, last_consent, email_len = _HEADER.unpack_from(data)
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported user record format version: {version}")
+    offset = _HEADER.size
+    email = data[offset:offset + email_len].decode()
+    offset += email_len
+    if code == CUSTOM_CODE:
+        (length,) = _SHORT_LENGTH.unpack_from(data, offset)
+        offset += _SHORT_LENGTH.size
+        cookie_preference = data[offset:offset + length].decode()
+        offset += length
+    else:
+        cookie_preference = COOKIE_PREFERENCE_NAMES[code]
+    (sessions_len,) = _LENGTH.unpack_from(data, offset)
+    offset += _LENGTH.size
+    sessions = json.loads(data[offset:offset + sessions_len]) if sessions_len else []
+
+    preferences = {}
+    for name in PREFERENCE_FIELDS:
+        if name == "cookie_preference":
+            preferences[name] = cookie_preference
+        else:
+            preferences[name] = bool(flags & _FLAG_BITS[name])
+    return {
+        "email": email,
+        "preferences": preferences,
+        "last_access": _from_micros(last_access),
+        "last_consent_update": _from_micros(last_consent),
+        "active_sessions": sessions,
+    }
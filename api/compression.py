@@ -0,0 +1,202 @@
+"""gzip/brotli response compression for the API.
+
+CompressionMiddleware picks an encoding from Accept-Encoding (brotli when the
+``brotli`` or ``brotlicffi`` package is installed and the client accepts it,
+otherwise gzip) and compresses responses whose content type is text-like
+and whose body reaches ``minimum_size``. Responses that already carry a
+Content-Encoding (the streamed export gzips itself), other content types
+(images, archives, octet streams) and ``Cache-Control: no-transform`` pass
+through untouched.
+
+Streaming responses are buffered only until the threshold is reached; after
+that every chunk the app sends is compressed and flushed on its own, so
+NDJSON streams still reach the client line batch by line batch.
+"""
+import zlib
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Accept-Encoding as {coding: q}"""
+    codings = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[name] = q
+    return codings
+
+
+def accepts_encoding(header: Optional[str], coding: str) -> bool:
+    """True if an Accept-Encoding header allows coding with a non-zero q"""
+    codings = parse_accept_encoding(header)
+    return codings.get(coding, codings.get("*", 0.0)) > 0
+
+
+class GzipEncoder:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing eligible responses with gzip or brotli"""
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 4,
+                 brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        # Preferred first when the client accepts several with the same q
+        self.codings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    def negotiate(self, header: Optional[str]) -> Optional[str]:
+        accepted = parse_accept_encoding(header)
+        best, best_q = None, 0.0
+        for coding in self.codings:
+            q = accepted.get(coding, accepted.get("*", 0.0))
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def encoder(self, coding: str):
+        if coding == "br":
+            return BrotliEncoder(self.brotli_quality)
+        return GzipEncoder(self.gzip_level)
+
+    def eligible(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return False
+        if "no-transform" in headers.get("cache-control", ""):
+            return False
+        content_type = headers.get("content-type", "").lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        length = headers.get("content-length")
+        return length is None or int(length) >= self.minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+        coding = self.negotiate(Headers(scope=scope).get("accept-encoding"))
+        if coding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        buffered = []
+        buffered_size = 0
+        encoder = None
+
+        async def send_compressed(message):
+            nonlocal start_message, buffered_size, encoder
+            if message["type"] == "http.response.start":
+                if message["status"] not in (204, 304) and self.eligible(Headers(raw=message["headers"])):
+                    start_message = message
+                else:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                buffered.append(body)
+                buffered_size += len(body)
+                if more_body and buffered_size < self.minimum_size:
+                    return
+                body = b"".join(buffered)
+                buffered.clear()
+                if buffered_size < self.minimum_size:
+                    # The whole response turned out to be small
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                encoder = self.encoder(coding)
+                if not more_body:
+                    compressed = encoder.compress(body) + encoder.finish()
+                    if len(compressed) >= len(body):
+                        await send(start_message)
+                        await send({"type": "http.response.body", "body": body})
+                        return
+                    self.mark_encoded(start_message, coding, len(compressed))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": compressed})
+                    return
+                self.mark_encoded(start_message, coding, None)
+                await send(start_message)
+
+            if more_body:
+                compressed = encoder.compress(body) + encoder.flush()
+                if compressed:
+                    await send({"type": "http.response.body", "body": compressed, "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": encoder.compress(body) + encoder.finish()})
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def mark_encoded(start_message, coding: str, length: Optional[int]) -> None:
+        headers = MutableHeaders(scope=start_message)
+        headers["Content-Encoding"] = coding
+        headers.add_vary_header("Accept-Encoding")
+        if length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(length)
+        # The compressed body is a different representation: keep the tag
+        # for If-None-Match (compared weakly) but stop claiming byte equality
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = "W/" + etag
@@ -0,0 +1,473 @@
+"""Append-only, encrypted log of consent changes.
+
+Every preference write (and erasure) appends an event to the active segment
+file under data/consent_log. Events are queued and written by one writer
+thread that appends everything pending and fsyncs once per batch (group
+commit). Segments are rotated at ``segment_max_bytes``.
+
+Segment files:
+
+    segment-00000001.log    records: >dQI header (timestamp, user tag, length)
+                            followed by a Fernet token of the event JSON
+    segment-00000001.idx    sparse index: >dQ (timestamp, offset) every
+                            ``index_every_bytes`` of log data
+    segment-00000001.users  Bloom filter of the user tags in a sealed segment
+
+Timestamps are strictly non-decreasing across segments, so a time window only
+touches the segments and offsets the sparse index points at. The user tag is
+a keyed hash of the email: per-user queries skip segments whose Bloom filter
+rules the user out and only decrypt records whose tag matches.
+
+Several processes (API workers) may share a directory: writes and recovery
+hold an exclusive lock on ``write.lock``, and each process first catches up
+with records and segments the others appended.
+"""
+import bisect
+import hashlib
+import hmac
+import json
+import os
+import queue
+import secrets
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from settings import file_lock
+
+_RECORD = struct.Struct(">dQI")
+_INDEX = struct.Struct(">dQ")
+_BLOOM_HASHES = 4
+_BLOOM_BITS_PER_ENTRY = 10
+
+
+class BloomFilter:
+    def __init__(self, size_bits: int, data: Optional[bytearray] = None):
+        self.size_bits = max(64, size_bits)
+        self.bits = data if data is not None else bytearray((self.size_bits + 7) // 8)
+
+    @classmethod
+    def for_tags(cls, tags) -> "BloomFilter":
+        bloom = cls(len(tags) * _BLOOM_BITS_PER_ENTRY)
+        for tag in tags:
+            bloom.add(tag)
+        return bloom
+
+    def _positions(self, tag: int):
+        h1 = tag & 0xFFFFFFFF
+        h2 = (tag >> 32) | 1
+        return [(h1 + i * h2) % self.size_bits for i in range(_BLOOM_HASHES)]
+
+    def add(self, tag: int) -> None:
+        for pos in self._positions(tag):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, tag: int) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(tag))
+
+    def to_bytes(self) -> bytes:
+        return struct.pack(">I", self.size_bits) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BloomFilter":
+        (size_bits,) = struct.unpack_from(">I", data)
+        return cls(size_bits, bytearray(data[4:]))
+
+
+class Segment:
+    def __init__(self, directory: Path, seq: int):
+        self.seq = seq
+        self.log_path = directory / f"segment-{seq:08d}.log"
+        self.idx_path = directory / f"segment-{seq:08d}.idx"
+        self.users_path = directory / f"segment-{seq:08d}.users"
+        self.index: List[tuple] = []
+        self.size = 0
+        self.tags = set()
+        self.bloom: Optional[BloomFilter] = None
+
+    @property
+    def first_ts(self) -> Optional[float]:
+        return self.index[0][0] if self.index else None
+
+    def load_index(self) -> None:
+        self.index = []
+        try:
+            data = self.idx_path.read_bytes()
+        except FileNotFoundError:
+            return
+        usable = len(data) - len(data) % _INDEX.size
+        for offset in range(0, usable, _INDEX.size):
+            self.index.append(_INDEX.unpack_from(data, offset))
+
+    def load_bloom(self) -> None:
+        try:
+            self.bloom = BloomFilter.from_bytes(self.users_path.read_bytes())
+        except FileNotFoundError:
+            self.bloom = None
+
+    def may_contain(self, tag: int) -> bool:
+        if self.bloom is not None:
+            return tag in self.bloom
+        return tag in self.tags if self.tags else True
+
+    def start_offset(self, start: Optional[float]) -> int:
+        """Offset of the last indexed record at or before ``start``"""
+        if start is None or not self.index:
+            return 0
+        position = bisect.bisect_right(self.index, (start, float("inf"))) - 1
+        return self.index[position][1] if position >= 0 else 0
+
+
+class _Waiter:
+    __slots__ = ("done", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class ConsentLog:
+    def __init__(
+        self,
+        directory="data/consent_log",
+        fernet=None,
+        segment_max_bytes: int = 64 * 1024 * 1024,
+        index_every_bytes: int = 64 * 1024,
+        max_batch: int = 1024,
+        fsync: bool = True,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fernet = fernet
+        self.segment_max_bytes = segment_max_bytes
+        self.index_every_bytes = index_every_bytes
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._last_ts = 0.0
+        self._last_indexed = -index_every_bytes
+        self.segments: List[Segment] = []
+        self._lock_path = self.directory / "write.lock"
+        with file_lock(self._lock_path):
+            self._tag_key = self._load_tag_key()
+            self._open_segments()
+        self._writer = threading.Thread(target=self._write_loop, name="consent-log", daemon=True)
+        self._writer.start()
+
+    # Setup and recovery
+
+    def _load_tag_key(self) -> bytes:
+        path = self.directory / "tag.key"
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            key = secrets.token_bytes(32)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                os.write(fd, key)
+            except Exception:
+                os.close(fd)
+                raise
+            os.close(fd)
+            return key
+
+    def user_tag(self, email: str) -> int:
+        digest = hmac.new(self._tag_key, email.encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def _open_segments(self) -> None:
+        seqs = sorted(int(p.stem.split("-")[1]) for p in self.directory.glob("segment-*.log"))
+        for seq in seqs:
+            segment = Segment(self.directory, seq)
+            segment.load_index()
+            segment.load_bloom()
+            segment.size = segment.log_path.stat().st_size
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 1))
+            self.segments[-1].log_path.touch()
+            return
+        self._recover_active(self.segments[-1])
+        if self.segments[-1].bloom is not None:
+            # Crashed right after sealing: keep the sealed segment untouched
+            self._start_segment(self.segments[-1].seq + 1)
+
+    def _recover_active(self, segment: Segment) -> None:
+        """Drop a torn tail left by a crash and rebuild in-memory state"""
+        valid = 0
+        last_ts = 0.0
+        with open(segment.log_path, "rb") as f:
+            data = f.read()
+        while valid + _RECORD.size <= len(data):
+            ts, tag, length = _RECORD.unpack_from(data, valid)
+            end = valid + _RECORD.size + length
+            if end > len(data):
+                break
+            segment.tags.add(tag)
+            last_ts = ts
+            valid = end
+        if valid != len(data):
+            with open(segment.log_path, "r+b") as f:
+                f.truncate(valid)
+        segment.size = valid
+        segment.index = [entry for entry in segment.index if entry[1] < valid]
+        with open(segment.idx_path, "wb") as f:
+            f.write(b"".join(_INDEX.pack(*entry) for entry in segment.index))
+        self._last_ts = max(last_ts, max((s.index[-1][0] for s in self.segments if s.index), default=0.0))
+        self._last_indexed = segment.index[-1][1] if segment.index else -self.index_every_bytes
+
+    def _refresh(self) -> None:
+        """Catch up with records and segments written by other processes"""
+        segment = self.segments[-1]
+        while True:
+            self._catch_up(segment)
+            following = Segment(self.directory, segment.seq + 1)
+            if not following.log_path.exists():
+                return
+            # Sealed and rolled over by another process
+            segment.load_bloom()
+            segment.tags = set()
+            self.segments.append(following)
+            segment = following
+
+    def _catch_up(self, segment: Segment) -> None:
+        size = segment.log_path.stat().st_size
+        if size == segment.size:
+            return
+        with open(segment.log_path, "rb") as f:
+            f.seek(segment.size)
+            data = f.read(size - segment.size)
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            ts, tag, length = _RECORD.unpack_from(data, offset)
+            segment.tags.add(tag)
+            self._last_ts = max(self._last_ts, ts)
+            offset += _RECORD.size + length
+        segment.size = size
+        segment.load_index()
+        self._last_indexed = segment.index[-1][1] if segment.index else -self.index_every_bytes
+
+    # Writing
+
+    def append(self, email: str, preferences: Optional[dict], wait: bool = True) -> None:
+        """Log a consent change (preferences=None records an erasure)"""
+        self.append_many([(email, preferences)], wait=wait)
+
+    def append_many(self, events: list, wait: bool = True) -> None:
+        """Queue events; with ``wait``, block until they are durable or raise
+        the error that made their batch fail"""
+        waiter = _Waiter() if wait else None
+        self._queue.put((events, waiter))
+        if waiter is not None:
+            waiter.done.wait()
+            if waiter.error is not None:
+                raise waiter.error
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write_batch(batch)
+                    return
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch: list) -> None:
+        error = None
+        try:
+            with self._lock, file_lock(self._lock_path):
+                self._refresh()
+                segment = self.segments[-1]
+                try:
+                    self._append_records(segment, batch)
+                except BaseException:
+                    self._rollback(segment)
+                    raise
+                if segment.size >= self.segment_max_bytes:
+                    try:
+                        self._roll()
+                    except OSError:
+                        pass  # the batch is durable; rolling is retried next batch
+        except Exception as exc:
+            # Fail this batch's callers, keep the writer alive for the next one
+            error = exc
+        finally:
+            for _, waiter in batch:
+                if waiter is not None:
+                    waiter.error = error
+                    waiter.done.set()
+
+    def _rollback(self, segment: Segment) -> None:
+        """Cut off whatever part of a failed batch reached the files"""
+        with open(segment.log_path, "r+b") as f:
+            f.truncate(segment.size)
+        with open(segment.idx_path, "ab") as f:
+            f.truncate(len(segment.index) * _INDEX.size)
+        self._last_indexed = segment.index[-1][1] if segment.index else -self.index_every_bytes
+
+    def _append_records(self, segment: Segment, batch: list) -> None:
+        records = []
+        index_entries = []
+        offset = segment.size
+        for events, _ in batch:
+            for email, preferences in events:
+                ts = max(time.time(), self._last_ts)
+                self._last_ts = ts
+                payload = self.fernet.encrypt(json.dumps(
+                    {"ts": ts, "email": email, "preferences": preferences}
+                ).encode())
+                tag = self.user_tag(email)
+                if offset - self._last_indexed >= self.index_every_bytes:
+                    index_entries.append((ts, offset))
+                    self._last_indexed = offset
+                records.append(_RECORD.pack(ts, tag, len(payload)) + payload)
+                segment.tags.add(tag)
+                offset += _RECORD.size + len(payload)
+        with open(segment.log_path, "ab") as f:
+            f.write(b"".join(records))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        if index_entries:
+            with open(segment.idx_path, "ab") as f:
+                f.write(b"".join(_INDEX.pack(*entry) for entry in index_entries))
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            segment.index.extend(index_entries)
+        segment.size = offset
+
+    def _roll(self) -> None:
+        sealed = self.segments[-1]
+        sealed.bloom = BloomFilter.for_tags(sealed.tags)
+        with open(sealed.users_path, "wb") as f:
+            f.write(sealed.bloom.to_bytes())
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        sealed.tags = set()
+        self._start_segment(sealed.seq + 1)
+
+    def _start_segment(self, seq: int) -> None:
+        segment = Segment(self.directory, seq)
+        segment.log_path.touch()
+        self.segments.append(segment)
+        self._last_indexed = -self.index_every_bytes
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._writer.join()
+
+    # Key rotation
+
+    def reencrypt(self, multi, primary) -> int:
+        """Re-encrypt every record not under ``primary``; returns how many.
+
+        Fernet tokens of the same plaintext have the same length, so records
+        keep their offsets and the index stays valid. Each segment is rewritten
+        to a temporary file and swapped in; only the active one is locked
+        against writers while that happens.
+        """
+        with self._lock, file_lock(self._lock_path):
+            self._refresh()
+            segments = list(self.segments)
+        rotated = 0
+        for segment in segments:
+            with self._lock:
+                active = segment is self.segments[-1]
+            if active:
+                with self._lock, file_lock(self._lock_path):
+                    self._refresh()
+                    rotated += self._reencrypt_segment(segment, multi, primary)
+            else:
+                rotated += self._reencrypt_segment(segment, multi, primary)
+        return rotated
+
+    def _reencrypt_segment(self, segment: Segment, multi, primary) -> int:
+        from cryptography.fernet import InvalidToken
+
+        data = bytearray(segment.log_path.read_bytes())
+        rotated = 0
+        offset = 0
+        while offset + _RECORD.size <= len(data):
+            _, _, length = _RECORD.unpack_from(data, offset)
+            start = offset + _RECORD.size
+            token = bytes(data[start:start + length])
+            offset = start + length
+            try:
+                primary.decrypt(token)
+                continue
+            except InvalidToken:
+                pass
+            new_token = multi.rotate(token)
+            if len(new_token) != length:
+                raise ValueError(f"re-encrypted record in {segment.log_path.name} changed size")
+            data[start:start + length] = new_token
+            rotated += 1
+        if rotated:
+            tmp_path = segment.log_path.with_suffix(".log.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, segment.log_path)
+        return rotated
+
+    # Reading
+
+    def query(
+        self,
+        email: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+    ) -> Iterator[dict]:
+        """Yield events in time order, filtered by user and/or [start, end]"""
+        tag = self.user_tag(email) if email is not None else None
+        with self._lock, file_lock(self._lock_path):
+            self._refresh()
+            segments = list(self.segments)
+            sizes = {segment.seq: segment.size for segment in segments}
+        for position, segment in enumerate(segments):
+            next_first = segments[position + 1].first_ts if position + 1 < len(segments) else None
+            if start is not None and next_first is not None and next_first < start:
+                continue
+            if end is not None and segment.first_ts is not None and segment.first_ts > end:
+                break
+            if tag is not None and not segment.may_contain(tag):
+                continue
+            for event in self._scan(segment, sizes[segment.seq], tag, start, end):
+                if email is None or event["email"] == email:
+                    yield event
+
+    def _scan(self, segment: Segment, size: int, tag, start, end) -> Iterator[dict]:
+        with open(segment.log_path, "rb") as f:
+            offset = segment.start_offset(start)
+            f.seek(offset)
+            while offset + _RECORD.size <= size:
+                ts, record_tag, length = _RECORD.unpack(f.read(_RECORD.size))
+                if end is not None and ts > end:
+                    return
+                if (start is not None and ts < start) or (tag is not None and record_tag != tag):
+                    f.seek(length, os.SEEK_CUR)
+                else:
+                    yield json.loads(self.fernet.decrypt(f.read(length)))
+                offset += _RECORD.size + length
+
+    def state_at(self, email: str, when: float) -> Optional[dict]:
+        """Preferences the user had consented to at ``when`` (None if unknown or erased)"""
+        latest = None
+        for event in self.query(email=email, end=when):
+            latest = event
+        return latest["preferences"] if latest is not None else None
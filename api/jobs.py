@@ -0,0 +1,369 @@
+"""Persistent background job queue for GDPR erasure and export requests.
+
+Jobs live in a SQLite table so they survive restarts. Worker threads claim a
+job by taking a lease on it; if a process dies mid-job the lease expires and
+another worker picks the job up again. Failed jobs are retried with
+exponential backoff until ``max_attempts`` is reached. ``concurrency`` caps
+how many jobs of each kind run at once in this process.
+
+Export results are written by ExportFiles as encrypted files; erasing a user
+purges them and marks the export jobs ``purged``.
+
+Once a job is finished its row keeps only a keyed digest of the email (see
+``email_digest``), so the table doesn't hold on to the addresses of erased
+users; the owner can still look the job up by digest.
+"""
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from settings import file_lock
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+PURGED = "purged"
+
+
+class JobQueue:
+    def __init__(
+        self,
+        path="data/jobs.db",
+        handlers: Optional[Dict[str, Callable[[str], dict]]] = None,
+        workers: int = 2,
+        concurrency: Optional[Dict[str, int]] = None,
+        max_attempts: int = 3,
+        retry_backoff: float = 5.0,
+        lease_seconds: float = 300.0,
+        poll_interval: float = 0.5,
+        email_key: bytes = b"",
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.handlers = handlers or {}
+        self.workers = workers
+        self.concurrency = concurrency or {}
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.email_key = email_key
+        self._local = threading.local()
+        self._running: Dict[str, int] = {}
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        conn = self._conn()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                email TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_after REAL NOT NULL,
+                lease_until REAL,
+                result TEXT,
+                error TEXT,
+                created_by TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    # Submitting and inspecting
+
+    def submit_many(self, kind: str, emails: List[str], created_by: Optional[str] = None) -> List[str]:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = time.time()
+        ids = [uuid.uuid4().hex for _ in emails]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                """INSERT INTO jobs (id, kind, email, status, max_attempts, run_after,
+                    created_by, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    (job_id, kind, email, QUEUED, self.max_attempts, now, created_by, now, now)
+                    for job_id, email in zip(ids, emails)
+                ],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._wakeup.set()
+        return ids
+
+    def submit(self, kind: str, email: str, created_by: Optional[str] = None) -> str:
+        return self.submit_many(kind, [email], created_by)[0]
+
+    def email_digest(self, email: str) -> str:
+        """What a finished job stores in place of ``email``"""
+        return "hmac:" + hmac.new(self.email_key, email.encode(), hashlib.sha256).hexdigest()
+
+    def is_owner(self, job: dict, email: str) -> bool:
+        return job["email"] in (email, self.email_digest(email))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def counts(self) -> dict:
+        rows = self._conn().execute(
+            "SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status"
+        ).fetchall()
+        counts = {}
+        for kind, status, count in rows:
+            counts.setdefault(kind, {})[status] = count
+        return counts
+
+    def purge_results(self, kind: str, email: str) -> List[dict]:
+        """Mark the user's succeeded jobs of ``kind`` purged; returns their old results"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Rows finished before digests were stored may still hold the email
+            keys = (kind, email, self.email_digest(email), SUCCEEDED)
+            rows = conn.execute(
+                "SELECT result FROM jobs WHERE kind = ?1 AND email IN (?2, ?3) AND status = ?4",
+                keys,
+            ).fetchall()
+            conn.execute(
+                """UPDATE jobs SET status = ?5, result = NULL, updated_at = ?6,
+                    created_by = CASE WHEN created_by = ?2 THEN ?3 ELSE created_by END,
+                    email = ?3
+                WHERE kind = ?1 AND email IN (?2, ?3) AND status = ?4""",
+                (*keys, PURGED, time.time()),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [json.loads(row["result"]) for row in rows if row["result"]]
+
+    # Workers
+
+    def start(self) -> None:
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work_loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _allowed_kinds(self) -> List[str]:
+        with self._running_lock:
+            return [
+                kind for kind in self.handlers
+                if self._running.get(kind, 0) < self.concurrency.get(kind, self.workers)
+            ]
+
+    def _claim(self) -> Optional[dict]:
+        kinds = self._allowed_kinds()
+        if not kinds:
+            return None
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                """SELECT * FROM jobs
+                WHERE kind IN (%s) AND (
+                    (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?)
+                )
+                ORDER BY run_after LIMIT 1""" % ",".join("?" * len(kinds)),
+                (*kinds, QUEUED, now, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                """UPDATE jobs SET status = ?, attempts = attempts + 1,
+                    lease_until = ?, updated_at = ? WHERE id = ?""",
+                (RUNNING, now + self.lease_seconds, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        job = dict(row)
+        job["attempts"] += 1
+        with self._running_lock:
+            self._running[job["kind"]] = self._running.get(job["kind"], 0) + 1
+        return job
+
+    def _finish(self, job: dict, result: Optional[dict], error: Optional[str]) -> None:
+        now = time.time()
+        email = self.email_digest(job["email"])
+        if error is None:
+            values = (SUCCEEDED, json.dumps(result), None, now, email, now)
+        elif job["attempts"] >= job["max_attempts"]:
+            values = (FAILED, None, error, now, email, now)
+        else:
+            backoff = self.retry_backoff * 2 ** (job["attempts"] - 1)
+            values = (QUEUED, None, error, now + backoff, job["email"], now)
+        # A job the user submitted themselves also names them in created_by
+        self._conn().execute(
+            """UPDATE jobs SET status = ?1, result = ?2, error = ?3, run_after = ?4,
+                lease_until = NULL,
+                created_by = CASE WHEN created_by = email THEN ?5 ELSE created_by END,
+                email = ?5, updated_at = ?6 WHERE id = ?7""",
+            (*values, job["id"]),
+        )
+        with self._running_lock:
+            self._running[job["kind"]] -= 1
+
+    def run_once(self) -> bool:
+        """Claim and run one ready job; False if there was nothing to do"""
+        job = self._claim()
+        if job is None:
+            return False
+        try:
+            result = self.handlers[job["kind"]](job["email"])
+        except Exception as e:
+            self._finish(job, None, "".join(traceback.format_exception_only(type(e), e)).strip())
+        else:
+            self._finish(job, result or {}, None)
+        return True
+
+    def _work_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except sqlite3.Error:
+                pass
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+class ExportFiles:
+    """Encrypted export results under ``directory``, one subdirectory per user.
+
+    A user's exports live in ``<prefix>/`` where the prefix is a hash of the
+    email, so an erasure finds every export of the user, including one whose
+    job hasn't recorded its result yet, without listing anyone else's.
+    Writers hold ``lock(email)`` (a lock file shared across processes,
+    striped on the prefix) while they load and write the data; ``purge`` and
+    ``reencrypt`` take it too, so a purged export is never written back.
+    """
+
+    def __init__(self, directory="data/exports", fernet=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fernet = fernet
+        self._lock_dir = self.directory / ".locks"
+        self._lock_dir.mkdir(exist_ok=True)
+
+    @staticmethod
+    def prefix(email: str) -> str:
+        return hashlib.sha256(email.encode()).hexdigest()[:16]
+
+    def lock(self, email: str):
+        return self._prefix_lock(self.prefix(email))
+
+    def _prefix_lock(self, prefix: str):
+        return file_lock(self._lock_dir / f"{prefix[:2]}.lock")
+
+    def write(self, email: str, data: dict) -> str:
+        """Encrypt and store ``data`` atomically; call with ``lock(email)`` held"""
+        user_dir = self.directory / self.prefix(email)
+        user_dir.mkdir(exist_ok=True)
+        path = user_dir / f"{uuid.uuid4().hex}.export"
+        self._replace(path, self.fernet.encrypt(json.dumps(data).encode()))
+        return f"{user_dir.name}/{path.name}"
+
+    def read(self, name: str) -> Optional[dict]:
+        try:
+            blob = (self.directory / name).read_bytes()
+        except FileNotFoundError:
+            return None
+        return json.loads(self.fernet.decrypt(blob))
+
+    def purge(self, email: str, names: Iterable[str] = ()) -> int:
+        """Delete the user's exports (plus ``names``); returns how many"""
+        removed = 0
+        user_dir = self.directory / self.prefix(email)
+        with self.lock(email):
+            paths = set(user_dir.glob("*.export")) if user_dir.is_dir() else set()
+            paths.update(self.directory / name for name in names)
+            for path in paths:
+                try:
+                    path.unlink()
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            try:
+                user_dir.rmdir()
+            except OSError:
+                pass  # absent, or holds leftover temp files
+        return removed
+
+    def reencrypt(self, multi, primary) -> int:
+        """Re-encrypt every export not under ``primary``; returns how many"""
+        from cryptography.fernet import InvalidToken
+
+        rotated = 0
+        # Exports written before per-user directories sit at the top level,
+        # named "<prefix>-<uuid>.export"; either way the name starts with the
+        # prefix that picks the lock stripe
+        paths = list(self.directory.glob("*/*.export")) + list(self.directory.glob("*.export"))
+        for path in sorted(paths):
+            prefix = path.parent.name if path.parent != self.directory else path.name
+            with self._prefix_lock(prefix):
+                try:
+                    blob = path.read_bytes()
+                except FileNotFoundError:
+                    continue  # purged meanwhile
+                try:
+                    primary.decrypt(blob)
+                    continue
+                except InvalidToken:
+                    pass
+                self._replace(path, multi.rotate(blob))
+                rotated += 1
+        return rotated
+
+    @staticmethod
+    def _replace(path: Path, blob: bytes) -> None:
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
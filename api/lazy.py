@@ -0,0 +1,49 @@
+"""Deferred construction of module-level resources.
+
+Opening stores, replaying the consent log or starting worker threads at
+import time makes every import of api/main.py pay for them (worker spawn,
+CLI tools, benchmarks). ``Lazy`` wraps a factory so the resource is built on
+first use, or up front by the app's lifespan hook.
+"""
+import threading
+
+
+class Lazy:
+    """Proxy that builds its object on first attribute access.
+
+    Attributes are forwarded, so call sites keep using the module global as
+    if it were the object; ``resolve()`` returns the object itself. The
+    proxy's own names are chosen not to shadow the wrapped object's (stores
+    have ``get``).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._created = False
+
+    @property
+    def resolved(self) -> bool:
+        return self._created
+
+    def resolve(self):
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self._factory()
+                    self._created = True
+        return self._value
+
+    def reset(self) -> None:
+        """Forget the object (after closing it); the next use builds a new one"""
+        with self._lock:
+            self._value = None
+            self._created = False
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self) -> str:
+        state = repr(self._value) if self._created else "not created"
+        return f"Lazy({state})"
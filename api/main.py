@@ -1,34 +1,119 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from datetime import datetime, timedelta
-from typing import Optional, List
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, constr
+from datetime import datetime, timedelta, timezone
+import time
+from typing import Iterator, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import hashlib
 import json
+import math
+import threading
+import uuid
+import zlib
 import os
-from pathlib import Path
-from cryptography.fernet import Fernet
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from storage import create_user_store
+from cache import LRUCache
+from codec import decode_user_record, encode_user_record
+from aggregates import ConsentAggregates
+from consent_log import ConsentLog
+from jobs import ExportFiles, JobQueue, SUCCEEDED
+from rotation import KeyRotationWorker, build_multifernet, load_keys_from_env
+from auth import AuthOverloaded, CredentialStore, PasswordHasher
+from sessions import SessionRegistry
+from metrics import Metrics, MetricsMiddleware, TimedStore
+from ratelimit import Rate, RateLimiter, RateLimitMiddleware, client_ip, load_route_limits
+from settings import ensure_secrets, load_env_file
+from lazy import Lazy
+from compression import CompressionMiddleware, accepts_encoding
+
+# Settings from .env; missing secrets are only generated when first needed
+# (once across worker processes, see api/settings.py)
+load_env_file()
+
+@asynccontextmanager
+async def lifespan(app):
+    # Open stores, replay the consent log and start background workers
+    # before the first request rather than at import time
+    await asyncio.get_running_loop().run_in_executor(None, open_resources)
+    yield
+    await asyncio.get_running_loop().run_in_executor(None, close_resources)
 
 # Initialize FastAPI app
-app = FastAPI(title="007 AI Agency API")
+app = FastAPI(title="007 AI Agency API", lifespan=lifespan)
+
+# gzip/brotli for text-like responses of at least COMPRESSION_MIN_SIZE bytes.
+# Added first so it runs innermost and its CPU time shows up in /metrics.
+if os.getenv("COMPRESSION_ENABLED", "1") != "0":
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+        gzip_level=int(os.getenv("COMPRESSION_GZIP_LEVEL", "4")),
+        brotli_quality=int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")),
+    )
+
+# Rate limiting: token buckets per client IP and per authenticated user,
+# configured per route. RATE_LIMITS is a JSON object overriding the defaults,
+# e.g. {"POST /token": {"ip": "5/min"}}; RATE_LIMIT_ENABLED=0 turns it off.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+RATE_LIMIT_DEFAULTS = {
+    "POST /token": {"ip": "10/min"},
+    "POST /export-data": {"ip": "30/min", "subject": "10/min"},
+    "POST /jobs/*": {"subject": "10/min"},
+    "*": {"ip": "600/min", "subject": "300/min"},
+}
+# Failed logins per username and client IP: successful logins don't count,
+# and guessing from another address can't lock the user out
+LOGIN_USERNAME_RATE = Rate.parse(os.getenv("LOGIN_RATE_PER_USERNAME", "5/min"))
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED_FOR", "0") == "1"
+rate_limiter = RateLimiter(max_keys=int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000")))
+
+def rate_limit_subject(scope) -> Optional[str]:
+    """User of an already verified bearer token; others only count per IP"""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer":
+                claims = token_cache.peek(token)
+                return claims[0] if claims else None
+    return None
 
-# CORS middleware
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(
+        RateLimitMiddleware,
+        limiter=rate_limiter,
+        limits=load_route_limits(os.getenv("RATE_LIMITS"), RATE_LIMIT_DEFAULTS),
+        subject=rate_limit_subject,
+        trust_forwarded=RATE_LIMIT_TRUST_FORWARDED,
+    )
+
+# Latency histograms and in-flight gauges per route, served at /metrics.
+# METRICS_SPANS=0 skips the storage/crypto/JWT spans.
+metrics = Metrics(spans=os.getenv("METRICS_SPANS", "1") != "0")
+app.add_middleware(MetricsMiddleware, metrics=metrics, router=app.router)
+
+# CORS middleware (added last so it also wraps 429 responses)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, replace with specific origins
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 # Security configurations
-SECRET_KEY = os.getenv("SECRET_KEY", Fernet.generate_key().decode())
+def get_secret_key() -> str:
+    ensure_secrets()
+    return os.environ["SECRET_KEY"]
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Data Models
@@ -36,18 +121,26 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
+# Input limits (422, or a per-line error in batches); the record codec
+# can't store strings over 64 KiB
+COOKIE_PREFERENCE_MAX_LENGTH = 64
+MAX_EMAIL_LENGTH = 254
+
 class UserPreferences(BaseModel):
     marketing_emails: bool = False
     product_updates: bool = True
     security_alerts: bool = True
     analytics_consent: bool = False
     personalization: bool = False
-    cookie_preference: str = "essential"
+    cookie_preference: constr(max_length=COOKIE_PREFERENCE_MAX_LENGTH) = "essential"
     essential_cookies: bool = True
     analytics_cookies: bool = False
     marketing_cookies: bool = False
     functional_cookies: bool = False
 
+class BulkErasureRequest(BaseModel):
+    emails: List[str]
+
 class UserData(BaseModel):
     email: str
     preferences: UserPreferences
@@ -56,124 +149,864 @@ class UserData(BaseModel):
     active_sessions: List[dict] = []
 
 # Encryption setup
-def get_encryption_key():
-    key = os.getenv("ENCRYPTION_KEY")
-    if not key:
-        key = Fernet.generate_key()
-        with open(".env", "a") as f:
-            f.write(f"\nENCRYPTION_KEY={key.decode()}")
-    return key if isinstance(key, bytes) else key.encode()
+def get_encryption_keys():
+    """ENCRYPTION_KEYS (newest first) or the single ENCRYPTION_KEY"""
+    ensure_secrets()
+    return load_keys_from_env()
+
+# Heavy resources are created on first use, or up front by the lifespan hook
+
+# Encrypts with the first key, decrypts with any of them
+fernet = Lazy(lambda: build_multifernet(get_encryption_keys()))
+
+# Storage backend (USER_STORE=file|sqlite)
+def open_user_store():
+    store = create_user_store()
+    return TimedStore(store, metrics) if metrics.spans_enabled else store
+
+user_store = Lazy(open_user_store)
+
+# Decoded preferences cache (PREFERENCE_CACHE_SIZE=0 disables it)
+preference_cache = LRUCache(
+    max_entries=int(os.getenv("PREFERENCE_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("PREFERENCE_CACHE_TTL", "300")),
+    max_bytes=int(os.getenv("PREFERENCE_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+)
+
+# Consent counters, updated with old/new diffs on every write and delete
+consent_aggregates = Lazy(lambda: ConsentAggregates(os.getenv("AGGREGATES_DB_PATH", "data/aggregates.db")))
 
-fernet = Fernet(get_encryption_key())
+# Append-only, encrypted history of every consent change and erasure
+consent_log = Lazy(lambda: ConsentLog(
+    os.getenv("CONSENT_LOG_DIR", "data/consent_log"),
+    fernet.resolve(),
+    segment_max_bytes=int(os.getenv("CONSENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024))),
+))
+
+# Login credentials (bcrypt hashes); manage users with ``python api/auth.py add-user``
+credential_store = Lazy(lambda: CredentialStore(os.getenv("CREDENTIALS_DB_PATH", "data/credentials.db")))
+
+# bcrypt runs in a bounded process pool; logins beyond LOGIN_MAX_PENDING get a 503
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("LOGIN_WORKERS", "0")) or None,
+    max_pending=int(os.getenv("LOGIN_MAX_PENDING", "0")) or None,
+    mode=os.getenv("LOGIN_HASH_MODE", "process"),
+)
+
+# Active sessions by token id; last-seen times are persisted in batches
+def open_session_registry():
+    registry = SessionRegistry(
+        os.getenv("SESSIONS_DB_PATH", "data/sessions.db"),
+        flush_interval=float(os.getenv("SESSION_FLUSH_INTERVAL", "5")),
+    )
+    registry.start()
+    return registry
+
+session_registry = Lazy(open_session_registry)
+
+# Verified JWT cache: token -> subject, each entry expires with the token
+token_cache = LRUCache(
+    max_entries=int(os.getenv("TOKEN_CACHE_SIZE", "4096")),
+    ttl=None,
+)
+
+# Blocking work (storage, crypto, JSON) runs on a bounded thread pool so the
+# event loop stays responsive; BLOCKING_IO_MODE=inline restores the old behaviour.
+BLOCKING_IO_MODE = os.getenv("BLOCKING_IO_MODE", "threadpool")
+blocking_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BLOCKING_IO_WORKERS", "8")),
+    thread_name_prefix="blocking-io",
+)
+
+async def run_blocking(func, *args):
+    if BLOCKING_IO_MODE == "inline":
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, func, *args)
 
 # Helper functions
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    from jose import jwt  # deferred: jose and its crypto backend are slow to import
+    return jwt.encode(to_encode, get_secret_key(), algorithm=ALGORITHM)
 
-def get_user_data_path(email: str) -> Path:
-    return Path(f"data/users/{email}.json")
+# New records use the compact binary codec; RECORD_FORMAT=json keeps writing
+# the legacy JSON documents. Both formats are always readable.
+RECORD_FORMAT = os.getenv("RECORD_FORMAT", "compact")
 
 def encrypt_data(data: dict) -> bytes:
-    return fernet.encrypt(json.dumps(data).encode())
+    with metrics.span("codec.encode"):
+        if RECORD_FORMAT == "json":
+            payload = json.dumps(data).encode()
+        else:
+            payload = encode_user_record(data)
+    with metrics.span("crypto.encrypt"):
+        return fernet.encrypt(payload)
 
 def decrypt_data(encrypted_data: bytes) -> dict:
-    return json.loads(fernet.decrypt(encrypted_data).decode())
+    with metrics.span("crypto.decrypt"):
+        payload = fernet.decrypt(encrypted_data)
+    with metrics.span("codec.decode"):
+        return decode_user_record(payload)
+
+# ETags hash the stored ciphertext, so they change on every write and can be
+# computed without decrypting. Users without a record share the defaults tag.
+DEFAULT_PREFERENCES_ETAG = '"d-%s"' % hashlib.sha256(
+    json.dumps(UserPreferences().dict(), sort_keys=True).encode()
+).hexdigest()[:32]
+
+def record_etag(blob: Optional[bytes]) -> str:
+    if blob is None:
+        return DEFAULT_PREFERENCES_ETAG
+    return '"%s"' % hashlib.sha256(blob).hexdigest()[:32]
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    """Evaluate an If-Match/If-None-Match header against the current tag"""
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            # GET always has a representation; If-Match: * needs a stored record
+            return weak or etag != DEFAULT_PREFERENCES_ETAG
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+# Striped locks serialise read-check-write cycles on the same record
+_record_locks = [threading.Lock() for _ in range(64)]
+
+def record_stripe(email: str) -> int:
+    return hash(email) % len(_record_locks)
+
+def record_lock(email: str) -> threading.Lock:
+    return _record_locks[record_stripe(email)]
+
+@contextmanager
+def record_locks(emails: list):
+    """Hold the stripes for many records, acquired in a fixed order"""
+    stripes = sorted({record_stripe(email) for email in emails})
+    for index in stripes:
+        _record_locks[index].acquire()
+    try:
+        yield
+    finally:
+        for index in reversed(stripes):
+            _record_locks[index].release()
+
+def stored_preferences(blob: Optional[bytes]) -> Optional[dict]:
+    return decrypt_data(blob)["preferences"] if blob is not None else None
+
+def load_preferences(email: str, if_none_match: Optional[str] = None) -> tuple:
+    """Return (UserPreferences, etag) for a user, using the cache.
+
+    When ``if_none_match`` matches the stored record the preferences are
+    None: the tag is computed from the ciphertext, so nothing is decrypted.
+    """
+    cached = preference_cache.get(email)
+    if cached is None:
+        generation = preference_cache.generation
+        blob = user_store.get(email)
+        etag = record_etag(blob)
+        if etag_matches(if_none_match, etag):
+            return None, etag
+        if blob is None:
+            preferences = UserPreferences()
+        else:
+            preferences = UserPreferences(**decrypt_data(blob)["preferences"])
+        cached = (preferences, etag)
+        preference_cache.set(email, cached, generation=generation)
+    return cached
+
+def build_user_record(email: str, preferences: UserPreferences) -> dict:
+    return {
+        "email": email,
+        "preferences": preferences.dict(),
+        "last_access": datetime.utcnow().isoformat(),
+        "last_consent_update": datetime.utcnow().isoformat(),
+        "active_sessions": []  # Sessions live in session_registry, added on export
+    }
+
+def save_preferences(
+    email: str, preferences: UserPreferences, if_match: Optional[str] = None
+) -> str:
+    """Write new preferences, honouring If-Match; returns the new ETag
+
+    The record lock only covers this process, so the write itself is a
+    compare-and-set against the blob that was checked: if another worker
+    wrote in between, the check (and the aggregate diff) runs again on
+    what it wrote.
+    """
+    with record_lock(email):
+        while True:
+            old_blob = user_store.get(email)
+            if if_match is not None:
+                current = record_etag(old_blob)
+                if not etag_matches(if_match, current, weak=False):
+                    # Another worker wrote it: this process's cached tag is
+                    # stale, and a client would GET it and fail again
+                    preference_cache.invalidate(email)
+                    raise HTTPException(
+                        status_code=status.HTTP_412_PRECONDITION_FAILED,
+                        detail="Preferences were modified by another client",
+                        headers={"ETag": current},
+                    )
+            blob = encrypt_data(build_user_record(email, preferences))
+            if user_store.compare_and_set(email, old_blob, blob):
+                break
+            preference_cache.invalidate(email)
+        preference_cache.invalidate(email)
+        consent_aggregates.record_change(stored_preferences(old_blob), preferences.dict())
+        consent_log.append(email, preferences.dict())
+    return record_etag(blob)
+
+def load_user_data(email: str, history: bool = True) -> Optional[dict]:
+    """The user's record and sessions, plus their consent history unless the
+    caller streams that itself (see user_consent_history)"""
+    blob = user_store.get(email)
+    if blob is None:
+        return None
+    data = decrypt_data(blob)
+    data["active_sessions"] = [session_view(s) for s in session_registry.list(email)]
+    if history:
+        data["consent_history"] = list(user_consent_history(email))
+    return data
+
+# Streaming exports are written out in EXPORT_CHUNK_SIZE pieces instead of
+# one response body, optionally gzip-compressed on the fly.
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", str(64 * 1024)))
+
+def iter_json_pieces(data: dict):
+    """Like JSONEncoder.iterencode, but iterator values are encoded as lists
+    one item at a time"""
+    encoder = json.JSONEncoder(default=str)
+    yield "{"
+    for position, (key, value) in enumerate(data.items()):
+        yield (", " if position else "") + json.dumps(key) + ": "
+        if isinstance(value, Iterator):
+            yield "["
+            for item_position, item in enumerate(value):
+                if item_position:
+                    yield ", "
+                yield from encoder.iterencode(item)
+            yield "]"
+        else:
+            yield from encoder.iterencode(value)
+    yield "}"
+
+def iter_export_json(data: dict):
+    buffer = []
+    size = 0
+    for piece in iter_json_pieces(data):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+def iter_export_ndjson(data: dict):
+    """One line per scalar field, one line per item of list fields"""
+    for key, value in data.items():
+        if isinstance(value, (list, Iterator)):
+            for item in value:
+                yield (json.dumps({"field": key, "item": item}, default=str) + "\n").encode()
+        else:
+            yield (json.dumps({"field": key, "value": value}, default=str) + "\n").encode()
+
+def gzip_chunks(chunks, level: int = 6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def delete_user(email: str) -> None:
+    with record_lock(email):
+        old_blob = user_store.get(email)
+        if user_store.delete(email):
+            consent_aggregates.record_change(stored_preferences(old_blob), None)
+            consent_log.append(email, None)
+        preference_cache.invalidate(email)
+    purge_exports(email)
+    session_registry.erase_user(email)
+
+# Batch operations: lines are grouped into chunks, crypto for a chunk is split
+# across the blocking pool and each chunk is written in groups that lock at
+# most BATCH_LOCK_STRIPES record stripes, so a PUT never waits for a whole chunk.
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+BATCH_LOCK_STRIPES = int(os.getenv("BATCH_LOCK_STRIPES", "8"))
+
+def encrypt_records(items: list) -> list:
+    """Encrypt (email, UserPreferences) pairs into (email, blob, preferences dict)"""
+    records = []
+    for email, preferences in items:
+        record = build_user_record(email, preferences)
+        records.append((email, encrypt_data(record), record["preferences"]))
+    return records
+
+def read_preferences_many(emails: list) -> list:
+    results = []
+    for email in emails:
+        preferences, etag = load_preferences(email)
+        results.append({
+            "email": email,
+            "status": "success",
+            "etag": etag,
+            "preferences": preferences.dict(),
+        })
+    return results
+
+def lock_groups(records: list):
+    """Split records, in order, into runs that touch at most BATCH_LOCK_STRIPES stripes"""
+    group = []
+    stripes = set()
+    for record in records:
+        stripe = record_stripe(record[0])
+        if stripe not in stripes and len(stripes) >= BATCH_LOCK_STRIPES:
+            yield group
+            group = []
+            stripes = set()
+        group.append(record)
+        stripes.add(stripe)
+    if group:
+        yield group
+
+def write_records(records: list) -> None:
+    for group in lock_groups(records):
+        emails = [email for email, _, _ in group]
+        with record_locks(emails):
+            old = {email: stored_preferences(user_store.get(email)) for email in emails}
+            user_store.put_many((email, blob) for email, blob, _ in group)
+            changes = []
+            for email, _, new in group:
+                preference_cache.invalidate(email)
+                # The same email may appear twice in a group; diff against the previous line
+                changes.append((old[email], new))
+                old[email] = new
+            consent_aggregates.record_changes(changes)
+            consent_log.append_many([(email, new) for email, _, new in group])
+
+async def run_sliced(func, items: list) -> list:
+    """Run func over items split into one slice per blocking worker"""
+    workers = blocking_executor._max_workers
+    size = max(1, -(-len(items) // workers))
+    slices = [items[i:i + size] for i in range(0, len(items), size)]
+    results = await asyncio.gather(*(run_blocking(func, part) for part in slices))
+    return [item for part in results for item in part]
+
+async def process_batch_chunk(chunk: list) -> list:
+    updates = [(email, prefs) for email, prefs in chunk if prefs is not None]
+    reads = [email for email, prefs in chunk if prefs is None]
+    results = []
+    if updates:
+        records = await run_sliced(encrypt_records, updates)
+        await run_blocking(write_records, records)
+        results.extend(
+            {"email": email, "status": "success", "etag": record_etag(blob)}
+            for email, blob, _ in records
+        )
+    if reads:
+        results.extend(await run_sliced(read_preferences_many, reads))
+    return results
+
+def parse_batch_line(line: bytes, line_no: int) -> tuple:
+    """Parse one NDJSON line into (email, UserPreferences or None for reads)"""
+    try:
+        item = json.loads(line)
+        email = item["email"]
+        if not isinstance(email, str) or not email:
+            raise ValueError("email must be a non-empty string")
+        if len(email) > MAX_EMAIL_LENGTH:
+            raise ValueError(f"email must be at most {MAX_EMAIL_LENGTH} characters")
+        preferences = item.get("preferences")
+        return email, UserPreferences(**preferences) if preferences is not None else None
+    except Exception as e:
+        raise ValueError(f"line {line_no}: {e}")
+
+async def iter_ndjson_lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+async def parse_batch_request(request: Request) -> list:
+    """Parse the NDJSON body into items and per-line parse errors"""
+    items = []
+    line_no = 0
+    async for line in iter_ndjson_lines(request):
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            items.append(parse_batch_line(line, line_no))
+        except ValueError as e:
+            items.append({"line": line_no, "status": "error", "detail": str(e)})
+    return items
+
+def ndjson_lines(results: list) -> str:
+    # One response chunk per batch chunk rather than per line, so each body
+    # message (and each compression flush) carries a useful amount of data
+    return "".join(json.dumps(result) + "\n" for result in results)
+
+async def stream_batch_results(items: list):
+    chunk = []
+    for item in items:
+        if isinstance(item, dict):
+            yield json.dumps(item) + "\n"
+            continue
+        chunk.append(item)
+        if len(chunk) >= BATCH_CHUNK_SIZE:
+            yield ndjson_lines(await process_batch_chunk(chunk))
+            chunk = []
+    if chunk:
+        yield ndjson_lines(await process_batch_chunk(chunk))
+
+def verify_token(token: str) -> tuple:
+    """Decode and fully verify a JWT, returning (subject, scopes, session id, expiry)"""
+    from jose import JWTError, jwt
+    try:
+        with metrics.span("jwt.decode"):
+            payload = jwt.decode(token, get_secret_key(), algorithms=[ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401)
+    email = payload.get("sub")
+    if not email:
+        raise HTTPException(status_code=401)
+    scopes = frozenset(payload.get("scope", "").split())
+    return email, scopes, payload.get("jti"), payload.get("exp")
+
+async def session_active(session_id: str) -> bool:
+    active = session_registry.touch(session_id)
+    if active is None:
+        active = await run_blocking(session_registry.load, session_id)
+    return active
+
+async def get_token_claims(token: str = Depends(oauth2_scheme)) -> tuple:
+    """Resolve (email, scopes, session id) for the bearer token, reusing earlier verifications.
+
+    Only tokens that passed signature and expiry checks are cached, keyed by
+    the full token string, and each entry expires no later than the token.
+    The session is checked on every request so revocation applies to cached
+    tokens too.
+    """
+    claims = token_cache.get(token)
+    if claims is None:
+        email, scopes, session_id, exp = verify_token(token)
+        claims = (email, scopes, session_id)
+        if exp is not None:
+            token_cache.set(token, claims, expires_at=time.monotonic() + (exp - time.time()))
+    # Tokens issued before session tracking carry no jti
+    if claims[2] is not None and not await session_active(claims[2]):
+        raise HTTPException(status_code=401, detail="Session has been revoked or expired")
+    return claims
+
+async def get_current_user(claims: tuple = Depends(get_token_claims)) -> str:
+    return claims[0]
+
+async def require_admin(claims: tuple = Depends(get_token_claims)) -> str:
+    email, scopes, _ = claims
+    if "admin" not in scopes:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin scope required")
+    return email
 
 # API Endpoints
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    # In production, implement proper user authentication
-    user_data = {"sub": form_data.username}
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    login_key = ("login", form_data.username, client_ip(request.scope, RATE_LIMIT_TRUST_FORWARDED))
+    if RATE_LIMIT_ENABLED:
+        # Only checked here; a failed attempt takes the token below
+        retry_after = rate_limiter.check(login_key, LOGIN_USERNAME_RATE)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many login attempts for this user",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+    credential = await run_blocking(credential_store.get, form_data.username)
+    password_hash, granted = credential if credential is not None else (None, frozenset())
+    try:
+        with metrics.span("auth.password_check"):
+            valid, new_hash = await password_hasher.verify(form_data.password, password_hash)
+    except AuthOverloaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many login attempts in progress, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+    if not valid:
+        if RATE_LIMIT_ENABLED:
+            rate_limiter.acquire(login_key, LOGIN_USERNAME_RATE)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    if new_hash:
+        await run_blocking(credential_store.update_hash, form_data.username, new_hash)
+    session_id = uuid.uuid4().hex
+    user_data = {"sub": form_data.username, "jti": session_id}
+    # Scopes come only from the checked credential, never from configuration
+    if "admin" in form_data.scopes and "admin" in granted:
+        user_data["scope"] = "admin"
     access_token = create_access_token(user_data)
+    await run_blocking(
+        session_registry.open,
+        session_id,
+        form_data.username,
+        time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+        request.headers.get("user-agent"),
+        request.client.host if request.client else None,
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/preferences")
-async def get_preferences(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=401)
-        
-        user_path = get_user_data_path(email)
-        if not user_path.exists():
-            return UserPreferences().dict()
-        
-        with open(user_path, "rb") as f:
-            data = decrypt_data(f.read())
-            return data["preferences"]
-            
-    except JWTError:
-        raise HTTPException(status_code=401)
+async def get_preferences(
+    request: Request,
+    response: Response,
+    email: str = Depends(get_current_user)
+):
+    if_none_match = request.headers.get("if-none-match")
+    preferences, etag = await run_blocking(load_preferences, email, if_none_match)
+    if preferences is None or etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
+    return preferences.dict()
 
 @app.put("/preferences")
 async def update_preferences(
     preferences: UserPreferences,
-    token: str = Depends(oauth2_scheme)
+    request: Request,
+    response: Response,
+    email: str = Depends(get_current_user)
 ):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=401)
-        
-        user_path = get_user_data_path(email)
-        user_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        user_data = {
-            "email": email,
-            "preferences": preferences.dict(),
-            "last_access": datetime.utcnow().isoformat(),
-            "last_consent_update": datetime.utcnow().isoformat(),
-            "active_sessions": []  # In production, implement session tracking
-        }
-        
-        with open(user_path, "wb") as f:
-            f.write(encrypt_data(user_data))
-            
-        return {"status": "success"}
-            
-    except JWTError:
-        raise HTTPException(status_code=401)
+    etag = await run_blocking(
+        save_preferences, email, preferences, request.headers.get("if-match")
+    )
+    response.headers["ETag"] = etag
+    return {"status": "success"}
 
 @app.post("/export-data")
-async def export_user_data(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=401)
-        
-        user_path = get_user_data_path(email)
-        if not user_path.exists():
-            raise HTTPException(status_code=404, detail="No data found")
-        
-        with open(user_path, "rb") as f:
-            data = decrypt_data(f.read())
-            return data
-            
-    except JWTError:
-        raise HTTPException(status_code=401)
+async def export_user_data(
+    request: Request,
+    stream: bool = False,
+    format: str = "json",
+    email: str = Depends(get_current_user)
+):
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    
+    data = await run_blocking(load_user_data, email, not stream)
+    if data is None:
+        raise HTTPException(status_code=404, detail="No data found")
+    
+    if not stream:
+        return data
+    
+    # Read lazily while the response is sent (sync iterators run in the threadpool)
+    data["consent_history"] = user_consent_history(email)
+    if format == "ndjson":
+        chunks = iter_export_ndjson(data)
+        media_type = "application/x-ndjson"
+    else:
+        chunks = iter_export_json(data)
+        media_type = "application/json"
+    headers = {"Content-Disposition": f'attachment; filename="export.{format}"'}
+    if accepts_encoding(request.headers.get("accept-encoding"), "gzip"):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
 
 @app.delete("/user-data")
-async def delete_user_data(token: str = Depends(oauth2_scheme)):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if not email:
-            raise HTTPException(status_code=401)
-        
-        user_path = get_user_data_path(email)
-        if user_path.exists():
-            user_path.unlink()
-        
-        return {"status": "success"}
-            
-    except JWTError:
-        raise HTTPException(status_code=401)
+async def delete_user_data(email: str = Depends(get_current_user)):
+    await run_blocking(delete_user, email)
+    return {"status": "success"}
+
+@app.post("/admin/preferences/batch")
+async def batch_preferences(request: Request, admin: str = Depends(require_admin)):
+    """Bulk read/update preferences from an NDJSON body.
+
+    Each line is {"email": ..., "preferences": {...}} to update, or just
+    {"email": ...} to read. One NDJSON result line is streamed back per input;
+    within a chunk, updates are applied (and reported) before reads.
+    The body is parsed before responding because Starlette consumes the
+    receive channel while a streaming response is in flight.
+    """
+    items = await parse_batch_request(request)
+    return StreamingResponse(stream_batch_results(items), media_type="application/x-ndjson")
+
+key_rotation_worker: Optional[KeyRotationWorker] = None
+
+@app.post("/admin/key-rotation", status_code=status.HTTP_202_ACCEPTED)
+async def start_key_rotation(admin: str = Depends(require_admin)):
+    """Start (or resume) re-encrypting all records under the primary key"""
+    global key_rotation_worker
+    if key_rotation_worker is not None and key_rotation_worker.running:
+        raise HTTPException(status_code=409, detail="Key rotation already running")
+    rate = os.getenv("KEY_ROTATION_BYTES_PER_SECOND")
+    key_rotation_worker = KeyRotationWorker(
+        user_store,
+        get_encryption_keys(),
+        checkpoint_path=os.getenv("KEY_ROTATION_CHECKPOINT", "data/key_rotation.json"),
+        records_per_second=float(os.getenv("KEY_ROTATION_RECORDS_PER_SECOND", "50")),
+        bytes_per_second=float(rate) if rate else None,
+        lock_for=record_lock,
+        on_rotated=preference_cache.invalidate,
+        extra_rotations=[
+            ("consent_log_rotated", consent_log.reencrypt),
+            ("exports_rotated", export_files.reencrypt),
+        ],
+    )
+    key_rotation_worker.start()
+    return key_rotation_worker.progress()
+
+@app.get("/admin/key-rotation")
+async def key_rotation_progress(admin: str = Depends(require_admin)):
+    if key_rotation_worker is None:
+        raise HTTPException(status_code=404, detail="No key rotation started")
+    return key_rotation_worker.progress()
+
+@app.get("/admin/consent-aggregates")
+async def consent_aggregate_counts(admin: str = Depends(require_admin)):
+    """Users per consent flag and cookie preference, read from the counters"""
+    return await run_blocking(consent_aggregates.snapshot)
+
+def to_epoch(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def consent_event_view(event: dict) -> dict:
+    return {
+        "timestamp": datetime.utcfromtimestamp(event["ts"]).isoformat(),
+        "email": event["email"],
+        "preferences": event["preferences"],
+    }
+
+def consent_events(email: Optional[str], start: Optional[datetime], end: Optional[datetime]) -> list:
+    return [
+        consent_event_view(event)
+        for event in consent_log.query(email=email, start=to_epoch(start), end=to_epoch(end))
+    ]
+
+def user_consent_history(email: str) -> Iterator[dict]:
+    """The user's consent events, oldest first, decrypted one at a time"""
+    return map(consent_event_view, consent_log.query(email=email))
+
+# Background GDPR jobs: erasures and exports are queued in SQLite and run by
+# worker threads, so the API can answer 202 straight away.
+export_files = Lazy(lambda: ExportFiles(os.getenv("EXPORT_DIR", "data/exports"), fernet.resolve()))
+
+def purge_exports(email: str) -> None:
+    """Delete the user's export files and mark their export jobs purged"""
+    results = job_queue.purge_results("export", email)
+    export_files.purge(email, [result["file"] for result in results if result.get("file")])
+
+def run_erasure_job(email: str) -> dict:
+    delete_user(email)
+    return {"erased": True}
+
+def run_export_job(email: str) -> dict:
+    # Load under the user's export lock: an erasure purging exports meanwhile
+    # either removes this file or runs first, and then there is nothing to export
+    with export_files.lock(email):
+        data = load_user_data(email)
+        if data is None:
+            return {"found": False}
+        return {"found": True, "file": export_files.write(email, data)}
+
+def start_job_queue():
+    queue = JobQueue(
+        os.getenv("JOBS_DB_PATH", "data/jobs.db"),
+        handlers={"erasure": run_erasure_job, "export": run_export_job},
+        workers=int(os.getenv("JOB_WORKERS", "4")),
+        concurrency={
+            "erasure": int(os.getenv("JOB_ERASURE_CONCURRENCY", "4")),
+            "export": int(os.getenv("JOB_EXPORT_CONCURRENCY", "2")),
+        },
+        max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        email_key=get_secret_key().encode(),
+    )
+    queue.start()
+    return queue
+
+job_queue = Lazy(start_job_queue)
+
+def job_view(job: dict) -> dict:
+    view = {
+        key: job[key]
+        for key in ("id", "kind", "email", "status", "attempts", "max_attempts", "error")
+    }
+    view["created_at"] = datetime.utcfromtimestamp(job["created_at"]).isoformat()
+    view["updated_at"] = datetime.utcfromtimestamp(job["updated_at"]).isoformat()
+    if job["kind"] == "export" and job["status"] == SUCCEEDED:
+        view["found"] = job["result"]["found"]
+        if view["found"]:
+            view["result_url"] = f"/jobs/{job['id']}/result"
+    return view
+
+def accepted_job(response: Response, job_id: str) -> dict:
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+async def get_visible_job(job_id: str, claims: tuple) -> dict:
+    email, scopes, _ = claims
+    job = await run_blocking(job_queue.get, job_id)
+    if job is None or (not job_queue.is_owner(job, email) and "admin" not in scopes):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/jobs/export", status_code=status.HTTP_202_ACCEPTED)
+async def submit_export_job(response: Response, email: str = Depends(get_current_user)):
+    job_id = await run_blocking(job_queue.submit, "export", email, email)
+    return accepted_job(response, job_id)
+
+@app.post("/jobs/erasure", status_code=status.HTTP_202_ACCEPTED)
+async def submit_erasure_job(response: Response, email: str = Depends(get_current_user)):
+    job_id = await run_blocking(job_queue.submit, "erasure", email, email)
+    return accepted_job(response, job_id)
+
+@app.post("/admin/jobs/erasure", status_code=status.HTTP_202_ACCEPTED)
+async def submit_bulk_erasure(request: BulkErasureRequest, admin: str = Depends(require_admin)):
+    """Queue one erasure job per email, e.g. to offboard a whole tenant"""
+    job_ids = await run_blocking(job_queue.submit_many, "erasure", request.emails, admin)
+    return {"job_ids": job_ids, "status": "queued"}
+
+@app.get("/admin/jobs")
+async def job_counts(admin: str = Depends(require_admin)):
+    return await run_blocking(job_queue.counts)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, claims: tuple = Depends(get_token_claims)):
+    return job_view(await get_visible_job(job_id, claims))
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str, claims: tuple = Depends(get_token_claims)):
+    job = await get_visible_job(job_id, claims)
+    if job["kind"] != "export" or job["status"] != SUCCEEDED or not job["result"]["found"]:
+        raise HTTPException(status_code=404, detail="No export available for this job")
+    
+    data = await run_blocking(export_files.read, job["result"]["file"])
+    if data is None:
+        raise HTTPException(status_code=404, detail="No export available for this job")
+    return data
+
+def session_view(session: dict, current: Optional[str] = None) -> dict:
+    view = {
+        "id": session["id"],
+        "created_at": datetime.utcfromtimestamp(session["created_at"]).isoformat(),
+        "last_seen": datetime.utcfromtimestamp(session["last_seen"]).isoformat(),
+        "expires_at": datetime.utcfromtimestamp(session["expires_at"]).isoformat(),
+        "user_agent": session["user_agent"],
+        "ip": session["ip"],
+    }
+    if current is not None:
+        view["current"] = session["id"] == current
+    return view
+
+@app.get("/sessions")
+async def list_sessions(claims: tuple = Depends(get_token_claims)):
+    email, _, session_id = claims
+    sessions = await run_blocking(session_registry.list, email)
+    return {"sessions": [session_view(s, session_id or "") for s in sessions]}
+
+@app.delete("/sessions/{session_id}")
+async def revoke_session(session_id: str, email: str = Depends(get_current_user)):
+    if not await run_blocking(session_registry.revoke, session_id, email):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"status": "success"}
+
+@app.delete("/sessions")
+async def revoke_other_sessions(claims: tuple = Depends(get_token_claims)):
+    """Sign out everywhere except the session making this request"""
+    email, _, session_id = claims
+    revoked = await run_blocking(session_registry.revoke_user, email, session_id)
+    return {"status": "success", "revoked": revoked}
+
+@app.get("/admin/sessions")
+async def admin_list_sessions(email: str, admin: str = Depends(require_admin)):
+    sessions = await run_blocking(session_registry.list, email)
+    return {"email": email, "sessions": [session_view(s) for s in sessions]}
+
+@app.delete("/admin/sessions")
+async def admin_revoke_sessions(email: str, admin: str = Depends(require_admin)):
+    revoked = await run_blocking(session_registry.revoke_user, email)
+    return {"email": email, "revoked": revoked}
+
+@app.get("/consent-history")
+async def consent_history(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    email: str = Depends(get_current_user)
+):
+    """The current user's consent changes (preferences=null marks an erasure)"""
+    return {"events": await run_blocking(consent_events, email, start, end)}
+
+@app.get("/admin/consent-history")
+async def admin_consent_history(
+    email: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    at: Optional[datetime] = None,
+    admin: str = Depends(require_admin)
+):
+    """Consent events by user and/or time window; with ``at`` the user's state then"""
+    if at is not None:
+        if email is None:
+            raise HTTPException(status_code=400, detail="email is required with at")
+        preferences = await run_blocking(consent_log.state_at, email, to_epoch(at))
+        return {"email": email, "at": at.isoformat(), "preferences": preferences}
+    return {"events": await run_blocking(consent_events, email, start, end)}
+
+# Startup and shutdown (run by the lifespan hook)
+def open_resources() -> None:
+    for resource in (fernet, user_store, consent_aggregates, consent_log,
+                     credential_store, session_registry, job_queue):
+        resource.resolve()
+
+def close_resources() -> None:
+    # Reset what was closed so the app can be started again in the same
+    # process (the benchmarks serve it once per mode)
+    if job_queue.resolved:
+        job_queue.stop(timeout=5)
+        job_queue.reset()
+    if session_registry.resolved:
+        session_registry.close()
+        session_registry.reset()
+    if consent_log.resolved:
+        consent_log.close()
+        consent_log.reset()
+    password_hasher.shutdown()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "preferences": preference_cache.stats(),
+        "tokens": token_cache.stats(),
+        "login": password_hasher.stats(),
+        "rate_limits": rate_limiter.stats(),
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Request latency histograms, in-flight gauges and spans (Prometheus text format)"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,198 @@
+"""Request and span latency metrics in the Prometheus text format.
+
+MetricsMiddleware records a latency histogram per (method, route, status)
+and an in-flight gauge per (method, route). Routes are labelled with their
+template ("/jobs/{job_id}"), never the raw path, so label cardinality stays
+bounded. ``Metrics.span`` times named blocks of work (storage calls, crypto,
+JWT decoding) into a histogram per span name.
+
+Recording is a bisect into a fixed bucket list plus a few additions under a
+lock. Metrics are per process; scrape every worker.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(names: Tuple[str, ...], values: Tuple) -> str:
+    return ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS, spans: bool = True, prefix: str = "api"):
+        self.buckets = buckets
+        self.spans_enabled = spans
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.requests: Dict[tuple, Histogram] = {}
+        self.in_flight: Dict[tuple, int] = {}
+        self.spans: Dict[str, Histogram] = {}
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float) -> None:
+        key = (method, route, status)
+        with self._lock:
+            histogram = self.requests.get(key)
+            if histogram is None:
+                histogram = self.requests[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def track_in_flight(self, method: str, route: str, delta: int) -> None:
+        key = (method, route)
+        with self._lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + delta
+
+    def observe_span(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.spans.get(name)
+            if histogram is None:
+                histogram = self.spans[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name: str):
+        if not self.spans_enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_span(name, time.perf_counter() - start)
+
+    def timed(self, name: str, func):
+        """Wrap func so every call is recorded as span ``name``"""
+        if not self.spans_enabled:
+            return func
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe_span(name, time.perf_counter() - start)
+        wrapper.__name__ = getattr(func, "__name__", name)
+        wrapper.__doc__ = getattr(func, "__doc__", None)
+        return wrapper
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format (0.0.4)"""
+        with self._lock:
+            requests = [(key, list(h.counts), h.sum, h.count) for key, h in self.requests.items()]
+            in_flight = list(self.in_flight.items())
+            spans = [((name,), list(h.counts), h.sum, h.count) for name, h in self.spans.items()]
+        lines: List[str] = []
+        self._render_histogram(
+            lines, f"{self.prefix}_request_duration_seconds",
+            "Request latency by method, route template and status",
+            ("method", "route", "status"), sorted(requests),
+        )
+        name = f"{self.prefix}_requests_in_flight"
+        lines.append(f"# HELP {name} Requests currently being served")
+        lines.append(f"# TYPE {name} gauge")
+        for key, value in sorted(in_flight):
+            lines.append(f"{name}{{{_labels(('method', 'route'), key)}}} {value}")
+        self._render_histogram(
+            lines, f"{self.prefix}_span_duration_seconds",
+            "Time spent in storage, crypto and token checks",
+            ("span",), sorted(spans),
+        )
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, lines, name, help_text, label_names, series) -> None:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+        for key, counts, total, count in series:
+            labels = _labels(label_names, key)
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {total}")
+            lines.append(f"{name}_count{{{labels}}} {count}")
+
+
+class TimedStore:
+    """Records a ``storage.<method>`` span around every user store call"""
+
+    _TIMED = ("get", "put", "delete", "exists", "put_many", "compare_and_set")
+
+    def __init__(self, store, metrics: Metrics):
+        self.store = store
+        for name in self._TIMED:
+            if hasattr(store, name):
+                setattr(self, name, metrics.timed(f"storage.{name}", getattr(store, name)))
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+class MetricsMiddleware:
+    """ASGI middleware feeding request latency and in-flight counts to Metrics"""
+
+    def __init__(self, app, metrics: Metrics, router):
+        self.app = app
+        self.metrics = metrics
+        self.router = router
+        self._static: Dict[tuple, str] = {}
+
+    def route_for(self, method: str, path: str) -> str:
+        route = self._static.get((method, path))
+        if route is not None:
+            return route
+        for candidate in self.router.routes:
+            regex = getattr(candidate, "path_regex", None)
+            if regex is None or not regex.match(path):
+                continue
+            methods = getattr(candidate, "methods", None)
+            if methods and method not in methods:
+                continue
+            if not getattr(candidate, "param_convertors", None):
+                # Only parameter-free routes are memoized, so the memo is bounded
+                self._static[(method, path)] = candidate.path
+            return candidate.path
+        return UNMATCHED_ROUTE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        route = self.route_for(method, scope["path"])
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        self.metrics.track_in_flight(method, route, 1)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.track_in_flight(method, route, -1)
+            self.metrics.observe_request(method, route, status_code, time.perf_counter() - start)
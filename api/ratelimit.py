@@ -0,0 +1,204 @@
+"""Token-bucket rate limiting for the API.
+
+Buckets are kept per (route rule, kind, key) in one OrderedDict in least
+recently used order. A bucket that has been idle long enough to refill
+completely is indistinguishable from a new one, so it is evicted from the
+cold end as soon as that happens; ``max_keys`` additionally caps memory when
+many distinct clients show up at once. Every check is O(1) amortized.
+
+The middleware runs on the event loop, so buckets need no lock.
+"""
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+_PERIODS = {"s": 1, "sec": 1, "second": 1, "m": 60, "min": 60, "minute": 60, "h": 3600, "hour": 3600}
+
+
+class Rate:
+    """``count`` requests per ``period`` seconds, with bursts up to ``count``"""
+
+    def __init__(self, count: float, period: float):
+        self.count = count
+        self.period = period
+        self.per_second = count / period
+
+    @classmethod
+    def parse(cls, spec: str) -> "Rate":
+        """Parse "10/min", "5/s" or "100/30" (seconds)"""
+        count, _, period = spec.strip().partition("/")
+        period = period.strip() or "s"
+        seconds = _PERIODS.get(period)
+        if seconds is None:
+            seconds = float(period)
+        return cls(float(count), seconds)
+
+    def __repr__(self) -> str:
+        return f"Rate({self.count:g}/{self.period:g}s)"
+
+
+class RouteLimit:
+    """Limits for requests matching ``pattern`` ("POST /token", "GET /jobs/*", "*")"""
+
+    def __init__(self, pattern: str, ip: Optional[Rate] = None, subject: Optional[Rate] = None):
+        self.pattern = pattern
+        method, _, path = pattern.partition(" ")
+        if not path:
+            method, path = "*", method
+        self.method = method.upper()
+        self.prefix = path.endswith("*")
+        self.path = path.rstrip("*")
+        self.ip = ip
+        self.subject = subject
+
+    def matches(self, method: str, path: str) -> bool:
+        if self.method != "*" and self.method != method:
+            return False
+        return path.startswith(self.path) if self.prefix else path == self.path
+
+
+def parse_route_limits(config: Dict[str, dict]) -> List[RouteLimit]:
+    """Build rules from {"POST /token": {"ip": "10/min", "subject": "5/min"}}"""
+    limits = []
+    for pattern, rates in config.items():
+        limits.append(RouteLimit(
+            pattern,
+            ip=Rate.parse(rates["ip"]) if rates.get("ip") else None,
+            subject=Rate.parse(rates["subject"]) if rates.get("subject") else None,
+        ))
+    # Exact routes before prefixes, longer prefixes before shorter ones
+    limits.sort(key=lambda limit: (limit.prefix, -len(limit.path), limit.method == "*"))
+    return limits
+
+
+def load_route_limits(value: Optional[str], defaults: Dict[str, dict]) -> List[RouteLimit]:
+    """Defaults overridden per route by a JSON object (e.g. from RATE_LIMITS)"""
+    config = dict(defaults)
+    if value:
+        config.update(json.loads(value))
+    return parse_route_limits(config)
+
+
+class RateLimiter:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> [tokens, updated_at, time to refill completely]
+        self._buckets: "OrderedDict[tuple, list]" = OrderedDict()
+        self.limited = 0
+
+    def acquire(self, key: tuple, rate: Rate, now: Optional[float] = None) -> float:
+        """Take one token; returns 0 on success or seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        self._evict(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(rate.count), now, rate.period]
+            self._buckets[key] = bucket
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(rate.count, bucket[0] + (now - bucket[1]) * rate.per_second)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        self.limited += 1
+        return (1 - bucket[0]) / rate.per_second
+
+    def check(self, key: tuple, rate: Rate, now: Optional[float] = None) -> float:
+        """Like acquire, but without taking a token: 0 if one is available"""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return 0.0
+        tokens = min(rate.count, bucket[0] + (now - bucket[1]) * rate.per_second)
+        if tokens >= 1:
+            return 0.0
+        self.limited += 1
+        return (1 - tokens) / rate.per_second
+
+    def _evict(self, now: float) -> None:
+        buckets = self._buckets
+        while buckets:
+            _, updated_at, refill = next(iter(buckets.values()))
+            if len(buckets) < self.max_keys and updated_at + refill > now:
+                return
+            buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def stats(self) -> dict:
+        return {"buckets": len(self._buckets), "max_keys": self.max_keys, "limited": self.limited}
+
+
+def client_ip(scope, trust_forwarded: bool = False) -> str:
+    if trust_forwarded:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class RateLimitMiddleware:
+    """ASGI middleware applying the first matching RouteLimit to each request.
+
+    ``subject`` maps the ASGI scope to the authenticated user (or None), so
+    per-subject limits follow a user across IPs.
+    """
+
+    def __init__(
+        self,
+        app,
+        limiter: RateLimiter,
+        limits: List[RouteLimit],
+        subject: Optional[Callable[[dict], Optional[str]]] = None,
+        trust_forwarded: bool = False,
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.limits = limits
+        self.subject = subject
+        self.trust_forwarded = trust_forwarded
+
+    def _match(self, method: str, path: str) -> Optional[RouteLimit]:
+        for limit in self.limits:
+            if limit.matches(method, path):
+                return limit
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self._match(scope["method"], scope["path"])
+        if limit is not None:
+            retry_after = self._check(limit, scope)
+            if retry_after:
+                return await self._reject(send, retry_after)
+        await self.app(scope, receive, send)
+
+    def _check(self, limit: RouteLimit, scope) -> float:
+        retry_after = 0.0
+        if limit.ip is not None:
+            key = (limit.pattern, "ip", client_ip(scope, self.trust_forwarded))
+            retry_after = self.limiter.acquire(key, limit.ip)
+        if not retry_after and limit.subject is not None and self.subject is not None:
+            subject = self.subject(scope)
+            if subject is not None:
+                retry_after = self.limiter.acquire((limit.pattern, "subject", subject), limit.subject)
+        return retry_after
+
+    async def _reject(self, send, retry_after: float) -> None:
+        body = json.dumps({"detail": "Too many requests"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,237 @@
+"""Encryption key rotation for stored user records.
+
+Keys come from ENCRYPTION_KEYS (comma separated, newest first) or the single
+ENCRYPTION_KEY. New writes always use the first key; reads accept any of them.
+KeyRotationWorker walks the store in email order and re-encrypts records that
+are not yet under the primary key, throttled and checkpointed so it can be
+resumed after a crash. Other encrypted data (the consent log) is passed in as
+``extra_rotations`` and re-encrypted after the records, before the run is
+marked finished.
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
+
+# cryptography is imported where it is used, so importing this module (and
+# main.py, which does) doesn't load it
+if TYPE_CHECKING:
+    from cryptography.fernet import MultiFernet
+
+
+def load_keys_from_env() -> List[bytes]:
+    keys = os.getenv("ENCRYPTION_KEYS") or os.getenv("ENCRYPTION_KEY") or ""
+    return [key.strip().encode() for key in keys.split(",") if key.strip()]
+
+
+def build_multifernet(keys: List[bytes]) -> "MultiFernet":
+    from cryptography.fernet import Fernet, MultiFernet
+    return MultiFernet([Fernet(key) for key in keys])
+
+
+def key_fingerprint(key: bytes) -> str:
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+class KeyRotationWorker:
+    """Re-encrypts every record under the primary key at a bounded rate"""
+
+    def __init__(
+        self,
+        store,
+        keys: List[bytes],
+        checkpoint_path="data/key_rotation.json",
+        records_per_second: Optional[float] = 50.0,
+        bytes_per_second: Optional[float] = None,
+        checkpoint_every: int = 100,
+        lock_for: Optional[Callable] = None,
+        on_rotated: Optional[Callable[[str], None]] = None,
+        extra_rotations: Sequence[Tuple[str, Callable]] = (),
+    ):
+        from cryptography.fernet import Fernet
+
+        self.store = store
+        self.multi = build_multifernet(keys)
+        self.primary = Fernet(keys[0])
+        self.fingerprint = key_fingerprint(keys[0])
+        self.checkpoint_path = Path(checkpoint_path)
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.checkpoint_every = checkpoint_every
+        self.lock_for = lock_for
+        self.on_rotated = on_rotated
+        # (name, rotate(multi, primary) -> count) run once the records are done
+        self.extra_rotations = list(extra_rotations)
+        self._stop = threading.Event()
+        self._thread = None
+        self.state = self._load_checkpoint()
+
+    def _new_state(self) -> dict:
+        return {
+            "primary_key": self.fingerprint,
+            "last_email": None,
+            "scanned": 0,
+            "rotated": 0,
+            "skipped": 0,
+            "conflicts": 0,
+            "failed": 0,
+            "bytes": 0,
+            "started_at": time.time(),
+            "finished_at": None,
+        }
+
+    def _load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return self._new_state()
+        # A checkpoint for an older primary key belongs to a previous rotation
+        if state.get("primary_key") != self.fingerprint:
+            return self._new_state()
+        return state
+
+    def _save_checkpoint(self) -> None:
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _is_primary(self, blob: bytes) -> bool:
+        from cryptography.fernet import InvalidToken
+
+        try:
+            self.primary.decrypt(blob)
+            return True
+        except InvalidToken:
+            return False
+
+    def _throttle(self, started: float, size: int) -> None:
+        delay = 0.0
+        if self.records_per_second:
+            delay = max(delay, 1.0 / self.records_per_second)
+        if self.bytes_per_second:
+            delay = max(delay, size / self.bytes_per_second)
+        remaining = delay - (time.monotonic() - started)
+        if remaining > 0:
+            self._stop.wait(remaining)
+
+    def rotate_one(self, email: str) -> tuple:
+        """Re-encrypt one record; returns (outcome, bytes of I/O done)"""
+        from cryptography.fernet import InvalidToken
+
+        blob = self.store.get(email)
+        if blob is None:
+            return "skipped", 0
+        if self._is_primary(blob):
+            return "skipped", len(blob)
+        try:
+            rotated = self.multi.rotate(blob)
+        except InvalidToken:
+            return "failed", len(blob)
+        if self.lock_for is not None:
+            with self.lock_for(email):
+                swapped = self.store.compare_and_set(email, blob, rotated)
+        else:
+            swapped = self.store.compare_and_set(email, blob, rotated)
+        if not swapped:
+            # Rewritten concurrently, and every write already uses the primary key
+            return "conflicts", len(blob)
+        if self.on_rotated is not None:
+            self.on_rotated(email)
+        return "rotated", len(blob) + len(rotated)
+
+    def run(self) -> dict:
+        if self.state["finished_at"] is not None:
+            return self.state
+        since_checkpoint = 0
+        for email in self.store.iter_emails(after=self.state["last_email"]):
+            if self._stop.is_set():
+                break
+            started = time.monotonic()
+            outcome, size = self.rotate_one(email)
+            self.state[outcome] += 1
+            self.state["bytes"] += size
+            self.state["scanned"] += 1
+            self.state["last_email"] = email
+            since_checkpoint += 1
+            if since_checkpoint >= self.checkpoint_every:
+                self._save_checkpoint()
+                since_checkpoint = 0
+            self._throttle(started, size)
+        else:
+            for name, rotate in self.extra_rotations:
+                if self._stop.is_set():
+                    break
+                self.state[name] = rotate(self.multi, self.primary)
+            else:
+                self.state["finished_at"] = time.time()
+        self._save_checkpoint()
+        return self.state
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="key-rotation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def progress(self) -> dict:
+        return dict(self.state, running=self.running)
+
+
+if __name__ == "__main__":
+    from consent_log import ConsentLog
+    from jobs import ExportFiles
+    from settings import load_env_file
+    from storage import create_user_store
+
+    load_env_file()
+
+    parser = argparse.ArgumentParser(description="Re-encrypt user records under the primary key")
+    parser.add_argument("--checkpoint", default="data/key_rotation.json")
+    parser.add_argument("--records-per-second", type=float, default=50.0)
+    parser.add_argument("--bytes-per-second", type=float, default=None)
+    args = parser.parse_args()
+
+    keys = load_keys_from_env()
+    if not keys:
+        parser.error("Set ENCRYPTION_KEYS (newest key first) or ENCRYPTION_KEY")
+    multi = build_multifernet(keys)
+    consent_log = ConsentLog(os.getenv("CONSENT_LOG_DIR", "data/consent_log"), multi)
+    export_files = ExportFiles(os.getenv("EXPORT_DIR", "data/exports"), multi)
+    worker = KeyRotationWorker(
+        create_user_store(),
+        keys,
+        checkpoint_path=args.checkpoint,
+        records_per_second=args.records_per_second,
+        bytes_per_second=args.bytes_per_second,
+        extra_rotations=[
+            ("consent_log_rotated", consent_log.reencrypt),
+            ("exports_rotated", export_files.reencrypt),
+        ],
+    )
+    worker.start()
+    try:
+        while worker.running:
+            time.sleep(5)
+            print(json.dumps(worker.progress()))
+    except KeyboardInterrupt:
+        print("\nStopping; progress is checkpointed and will resume on the next run")
+        worker.stop()
+    consent_log.close()
+    print(json.dumps(worker.progress()))
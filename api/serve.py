@@ -0,0 +1,51 @@
+"""Run the API on several worker processes.
+
+Loads .env and creates any missing secrets once in this process, before
+uvicorn starts the workers; each worker inherits the same environment, so
+JWTs issued by one worker verify on every other and all of them encrypt
+with the same key.
+
+    python api/serve.py --workers 4 --port 8000
+
+Per-process state to keep in mind with several workers: the preferences
+cache (its TTL defaults to 5 seconds here unless PREFERENCE_CACHE_TTL is
+set), token cache, rate limit buckets and /metrics are per worker.
+Sessions, jobs, consent counters and the consent log are shared on disk.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the preferences API on N worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--env-file", default=None, help="Defaults to API_ENV_FILE or .env")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(API_DIR))
+    from settings import load_settings
+
+    load_settings(args.env_file)
+    if args.workers > 1:
+        os.environ.setdefault("PREFERENCE_CACHE_TTL", "5")
+
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        app_dir=str(API_DIR),
+        log_level=args.log_level,
+    )
+
+
+if __name__ == "__main__":
+    main()
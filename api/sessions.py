@@ -0,0 +1,320 @@
+"""In-memory registry of active sessions, persisted in batches.
+
+Every access token carries a session id (the JWT ``jti``). Sessions are
+written once when opened; touching or revoking one afterwards is a dict
+operation and nothing is written per request.
+Expiry is tracked with a min-heap of (expires_at, session id): sessions only
+ever expire at their token's ``exp``, so heap entries never need updating and
+revoked sessions are dropped lazily when their entry comes up.
+
+A background thread sweeps expired sessions and every ``flush_interval``
+writes changed sessions and revocations to SQLite in one transaction. The
+same flush picks up revocations made by other processes sharing the
+database, so a revoked token stops working everywhere within one interval.
+"""
+import heapq
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+
+class SessionRegistry:
+    def __init__(
+        self,
+        path="data/sessions.db",
+        flush_interval: float = 5.0,
+        touch_resolution: float = 60.0,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        # last_seen is only re-persisted once it moved by this many seconds
+        self.touch_resolution = touch_resolution
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._sessions: Dict[str, dict] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        self._revoked: Dict[str, float] = {}
+        self._expiry: List[tuple] = []
+        self._dirty: Set[str] = set()
+        self._pending_revocations: Dict[str, float] = {}
+        self._last_sync = time.time()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._conn = sqlite3.connect(str(self.path), timeout=30.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                email TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_seen REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                user_agent TEXT,
+                ip TEXT,
+                revoked_at REAL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_revoked ON sessions (revoked_at)")
+        self._conn.commit()
+        self._load()
+
+    def _load(self) -> None:
+        now = time.time()
+        with self._db_lock:
+            rows = self._conn.execute(
+                """SELECT sid, email, created_at, last_seen, expires_at, user_agent, ip, revoked_at
+                FROM sessions WHERE expires_at > ?""",
+                (now,),
+            ).fetchall()
+        with self._lock:
+            for sid, email, created_at, last_seen, expires_at, user_agent, ip, revoked_at in rows:
+                if revoked_at is not None:
+                    self._revoked[sid] = expires_at
+                else:
+                    self._add(sid, email, created_at, last_seen, expires_at, user_agent, ip)
+                heapq.heappush(self._expiry, (expires_at, sid))
+
+    def _add(self, sid, email, created_at, last_seen, expires_at, user_agent, ip) -> dict:
+        session = {
+            "id": sid,
+            "email": email,
+            "created_at": created_at,
+            "last_seen": last_seen,
+            "expires_at": expires_at,
+            "user_agent": user_agent,
+            "ip": ip,
+            "_persisted_seen": last_seen,
+        }
+        self._sessions[sid] = session
+        self._by_user.setdefault(email, set()).add(sid)
+        return session
+
+    # Request path
+
+    def open(
+        self,
+        sid: str,
+        email: str,
+        expires_at: float,
+        user_agent: Optional[str] = None,
+        ip: Optional[str] = None,
+    ) -> None:
+        """Register a new session; written through so other processes see it"""
+        now = time.time()
+        user_agent = (user_agent or "")[:200] or None
+        with self._db_lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO sessions
+                (sid, email, created_at, last_seen, expires_at, user_agent, ip)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (sid, email, now, now, expires_at, user_agent, ip),
+            )
+            self._conn.commit()
+        with self._lock:
+            self._add(sid, email, now, now, expires_at, user_agent, ip)
+            heapq.heappush(self._expiry, (expires_at, sid))
+
+    def touch(self, sid: str) -> Optional[bool]:
+        """Mark a session as used: True if active, False if revoked or
+        expired, None if this process has never seen it (see ``load``)"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                return False if sid in self._revoked else None
+            if session["expires_at"] <= now:
+                return False
+            session["last_seen"] = now
+            if now - session["_persisted_seen"] >= self.touch_resolution:
+                self._dirty.add(sid)
+            return True
+
+    def load(self, sid: str) -> bool:
+        """Fetch a session opened by another process; True if it is active"""
+        with self._db_lock:
+            row = self._conn.execute(
+                """SELECT sid, email, created_at, last_seen, expires_at, user_agent, ip, revoked_at
+                FROM sessions WHERE sid = ?""",
+                (sid,),
+            ).fetchone()
+        if row is None or row[4] <= time.time():
+            return False
+        with self._lock:
+            if row[7] is not None or sid in self._revoked:
+                self._revoked[sid] = row[4]
+                return False
+            if sid not in self._sessions:
+                self._add(*row[:7])
+                heapq.heappush(self._expiry, (row[4], sid))
+        return self.touch(sid) is True
+
+    def revoke(self, sid: str, email: Optional[str] = None) -> bool:
+        """Revoke one session (only if it belongs to ``email`` when given)"""
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is not None:
+                if email is not None and session["email"] != email:
+                    return False
+                self._remove(sid)
+                self._revoked[sid] = session["expires_at"]
+                self._pending_revocations[sid] = now
+                return True
+        # Possibly opened by another process
+        with self._db_lock:
+            cursor = self._conn.execute(
+                """UPDATE sessions SET revoked_at = ?
+                WHERE sid = ? AND email = COALESCE(?, email) AND revoked_at IS NULL AND expires_at > ?""",
+                (now, sid, email, now),
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def revoke_user(self, email: str, keep: Optional[str] = None) -> int:
+        """Revoke all of a user's sessions except ``keep``; returns how many"""
+        self.flush()
+        now = time.time()
+        with self._lock:
+            for sid in [sid for sid in self._by_user.get(email, ()) if sid != keep]:
+                self._revoked[sid] = self._sessions[sid]["expires_at"]
+                self._remove(sid)
+        with self._db_lock:
+            cursor = self._conn.execute(
+                """UPDATE sessions SET revoked_at = ?
+                WHERE email = ? AND sid != ? AND revoked_at IS NULL AND expires_at > ?""",
+                (now, email, keep or "", now),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def erase_user(self, email: str) -> int:
+        """Revoke all of a user's sessions and drop what identifies them.
+
+        Revoked rows keep only the session id and times until their token
+        expires, so other processes still see the revocation; expired rows
+        are deleted. Returns how many sessions were revoked.
+        """
+        revoked = self.revoke_user(email)
+        with self._db_lock:
+            self._conn.execute(
+                "DELETE FROM sessions WHERE email = ? AND expires_at <= ?", (email, time.time())
+            )
+            self._conn.execute(
+                "UPDATE sessions SET email = '', user_agent = NULL, ip = NULL WHERE email = ?",
+                (email,),
+            )
+            self._conn.commit()
+        return revoked
+
+    def _remove(self, sid: str) -> None:
+        session = self._sessions.pop(sid)
+        sids = self._by_user.get(session["email"])
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self._by_user[session["email"]]
+        self._dirty.discard(sid)
+
+    def list(self, email: str) -> List[dict]:
+        """Active sessions of a user across all processes sharing the database"""
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute(
+                """SELECT sid, created_at, last_seen, expires_at, user_agent, ip FROM sessions
+                WHERE email = ? AND revoked_at IS NULL AND expires_at > ? ORDER BY created_at""",
+                (email, time.time()),
+            ).fetchall()
+        with self._lock:
+            return [
+                {
+                    "id": sid,
+                    "created_at": created_at,
+                    "last_seen": max(last_seen, self._sessions.get(sid, {}).get("last_seen", 0)),
+                    "expires_at": expires_at,
+                    "user_agent": user_agent,
+                    "ip": ip,
+                }
+                for sid, created_at, last_seen, expires_at, user_agent, ip in rows
+                if sid not in self._revoked
+            ]
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # Background sweeping and persistence
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Drop sessions and revocations whose token has expired"""
+        now = time.time() if now is None else now
+        expired = 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires_at, sid = heapq.heappop(self._expiry)
+                session = self._sessions.get(sid)
+                if session is not None and session["expires_at"] == expires_at:
+                    self._remove(sid)
+                    expired += 1
+                elif self._revoked.get(sid) == expires_at:
+                    del self._revoked[sid]
+        return expired
+
+    def flush(self) -> None:
+        with self._lock:
+            changed = [
+                (sid, s["email"], s["created_at"], s["last_seen"], s["expires_at"], s["user_agent"], s["ip"])
+                for sid in self._dirty
+                for s in (self._sessions[sid],)
+            ]
+            for sid in self._dirty:
+                self._sessions[sid]["_persisted_seen"] = self._sessions[sid]["last_seen"]
+            self._dirty = set()
+            revocations = list(self._pending_revocations.items())
+            self._pending_revocations = {}
+        now = time.time()
+        with self._db_lock:
+            self._conn.executemany(
+                """INSERT INTO sessions (sid, email, created_at, last_seen, expires_at, user_agent, ip)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(sid) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)""",
+                changed,
+            )
+            self._conn.executemany(
+                "UPDATE sessions SET revoked_at = ? WHERE sid = ?",
+                [(revoked_at, sid) for sid, revoked_at in revocations],
+            )
+            self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            remote = self._conn.execute(
+                "SELECT sid, expires_at FROM sessions WHERE revoked_at >= ?",
+                (self._last_sync - self.flush_interval,),
+            ).fetchall()
+            self._conn.commit()
+        self._last_sync = now
+        with self._lock:
+            for sid, expires_at in remote:
+                if sid in self._sessions:
+                    self._remove(sid)
+                self._revoked[sid] = expires_at
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-registry", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.sweep()
+                self.flush()
+            except sqlite3.Error:
+                pass
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        self._conn.close()
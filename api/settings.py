@@ -0,0 +1,118 @@
+"""Configuration and secrets shared by every API worker process.
+
+``load_env_file`` copies the values from the env file (``.env`` by default,
+``API_ENV_FILE`` to change it) into ``os.environ`` without overriding
+variables that are already set. If ``SECRET_KEY`` or the encryption key is
+still missing, ``ensure_secrets`` generates it exactly once: the file is
+re-read under an exclusive lock, missing keys are generated and the file is
+rewritten atomically, so workers starting at the same time all end up with
+the same keys. ``load_settings`` does both; ``python api/serve.py`` calls it once
+before starting the workers, which then simply inherit the environment.
+"""
+import os
+import secrets
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock on ``path`` (created if needed), across processes"""
+    fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        yield
+    finally:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        os.close(fd)
+
+
+def _generate_fernet_key() -> str:
+    from cryptography.fernet import Fernet
+    return Fernet.generate_key().decode()
+
+
+GENERATED_SECRETS = {
+    "SECRET_KEY": lambda: secrets.token_urlsafe(48),
+    "ENCRYPTION_KEY": _generate_fernet_key,
+}
+
+
+def missing_secrets() -> List[str]:
+    missing = [] if os.getenv("SECRET_KEY") else ["SECRET_KEY"]
+    if not os.getenv("ENCRYPTION_KEYS") and not os.getenv("ENCRYPTION_KEY"):
+        missing.append("ENCRYPTION_KEY")
+    return missing
+
+
+def _apply(values: Dict[str, str]) -> None:
+    for name, value in values.items():
+        if value is not None and name not in os.environ:
+            os.environ[name] = value
+
+
+def _append_atomic(path: Path, lines: List[str]) -> None:
+    existing = path.read_text() if path.exists() else ""
+    if existing and not existing.endswith("\n"):
+        existing += "\n"
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(existing + "".join(line + "\n" for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def env_file_path(env_file=None) -> Path:
+    return Path(env_file or os.getenv("API_ENV_FILE", ".env"))
+
+
+def load_env_file(env_file=None) -> None:
+    """Apply the env file without generating anything (for command-line tools)"""
+    path = env_file_path(env_file)
+    if path.exists():
+        from dotenv import dotenv_values
+        _apply(dotenv_values(path))
+
+
+def ensure_secrets(env_file=None) -> None:
+    """Generate missing secrets into the env file, once across processes"""
+    if not missing_secrets():
+        return
+    from dotenv import dotenv_values
+    path = env_file_path(env_file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_name(path.name + ".lock")):
+        # Another worker may have created them while we waited
+        if path.exists():
+            _apply(dotenv_values(path))
+        generated = {name: GENERATED_SECRETS[name]() for name in missing_secrets()}
+        if generated:
+            _append_atomic(path, [f"{name}={value}" for name, value in generated.items()])
+            _apply(generated)
+
+
+def load_settings(env_file=None) -> None:
+    load_env_file(env_file)
+    ensure_secrets(env_file)
@@ -0,0 +1,482 @@
+"""Pluggable storage backends for encrypted user records.
+
+Records are stored as opaque encrypted blobs keyed by email; encryption and
+decoding stay in main.py so every backend only ever sees ciphertext.
+"""
+import argparse
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+from settings import file_lock
+
+
+class UserStore:
+    """Interface shared by all user record backends"""
+
+    def get(self, email: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def put(self, email: str, blob: bytes) -> None:
+        raise NotImplementedError
+
+    def delete(self, email: str) -> bool:
+        raise NotImplementedError
+
+    def exists(self, email: str) -> bool:
+        return self.get(email) is not None
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> int:
+        count = 0
+        for email, blob in items:
+            self.put(email, blob)
+            count += 1
+        return count
+
+    def compare_and_set(self, email: str, expected: Optional[bytes], blob: bytes) -> bool:
+        """Replace a record only if it still holds ``expected`` (None: only create it)"""
+        if self.get(email) != expected:
+            return False
+        self.put(email, blob)
+        return True
+
+    def iter_emails(self, after: Optional[str] = None) -> Iterator[str]:
+        """Yield emails in sorted order, starting after ``after`` if given"""
+        raise NotImplementedError
+
+    def iter_records(self, unreadable: Optional[List[str]] = None) -> Iterator[Tuple[str, bytes]]:
+        """Yield (email, blob); emails listed but not readable go to ``unreadable``"""
+        for email in self.iter_emails():
+            blob = self.get(email)
+            if blob is not None:
+                yield email, blob
+            elif unreadable is not None:
+                unreadable.append(email)
+
+    def close(self) -> None:
+        pass
+
+
+class FileUserStore(UserStore):
+    """One encrypted file per user under data/users.
+
+    The ``sharded`` layout spreads files over two levels of directories named
+    after the email's SHA-256 (``ab/cd/<email>.json``) so no directory grows
+    past a few thousand entries. ``flat`` is the original single directory.
+    File names are the percent-quoted email; files written before that under
+    the raw email (``o'brien@x.com.json``) are still found in the flat
+    directory.
+    With ``legacy_fallback`` the sharded store also reads (and cleans up)
+    files still sitting in the flat layout, so a tree can be resharded while
+    the API is serving it. Writes go to a temp file that is fsynced and then
+    atomically renamed over the record, so a crash never leaves a truncated
+    ciphertext behind.
+
+    Writes, deletes and ``compare_and_set`` hold a per-record lock file
+    (striped over ``.locks/<nn>.lock``), so a compare-and-set from the
+    rotation CLI or another worker process can't lose a concurrent write.
+    """
+
+    def __init__(self, root="data/users", layout="sharded", legacy_fallback=True, fsync=True):
+        if layout not in ("sharded", "flat"):
+            raise ValueError(f"Unknown file layout: {layout}")
+        self.root = Path(root)
+        self.layout = layout
+        self.legacy_fallback = legacy_fallback and layout == "sharded"
+        self.fsync = fsync
+
+    @staticmethod
+    def filename_for(email: str) -> str:
+        return quote(email, safe="@.+-_") + ".json"
+
+    @classmethod
+    def email_for(cls, filename: str) -> str:
+        stem = filename[:-len(".json")]
+        email = unquote(stem)
+        # Not a quoted name: a legacy file named after the raw email
+        return email if cls.filename_for(email) == filename else stem
+
+    def flat_path_for(self, email: str) -> Path:
+        return self.root / self.filename_for(email)
+
+    def legacy_path_for(self, email: str) -> Optional[Path]:
+        """The flat file under the raw email, as the first file store named them"""
+        path = self.root / f"{email}.json"
+        if path.parent != self.root or path == self.flat_path_for(email):
+            return None
+        return path
+
+    def _paths_for(self, email: str) -> List[Path]:
+        """Where the record may live, the current location first"""
+        paths = [self.path_for(email)]
+        if self.layout == "flat" or self.legacy_fallback:
+            paths.append(self.flat_path_for(email))
+            paths.append(self.legacy_path_for(email))
+        return list(dict.fromkeys(path for path in paths if path is not None))
+
+    def sharded_path_for(self, email: str) -> Path:
+        digest = hashlib.sha256(email.encode()).hexdigest()
+        return self.root / digest[:2] / digest[2:4] / self.filename_for(email)
+
+    def path_for(self, email: str) -> Path:
+        if self.layout == "flat":
+            return self.flat_path_for(email)
+        return self.sharded_path_for(email)
+
+    def record_lock(self, email: str):
+        """Exclusive lock on the record's stripe, across threads and processes"""
+        lock_dir = self.root / ".locks"
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256(email.encode()).hexdigest()
+        return file_lock(lock_dir / f"{digest[:2]}.lock")
+
+    def get(self, email: str) -> Optional[bytes]:
+        for path in self._paths_for(email):
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _write_atomic(self, path: Path, blob: bytes, replace: bool = True) -> bool:
+        """Write via temp file + fsync + rename; with replace=False never clobber"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.parent / f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if replace:
+                os.replace(tmp_path, path)
+            else:
+                try:
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    return False
+            if self.fsync:
+                self._fsync_dir(path.parent)
+            return True
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    @staticmethod
+    def _fsync_dir(directory: Path) -> None:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def put(self, email: str, blob: bytes) -> None:
+        with self.record_lock(email):
+            self._put(email, blob)
+
+    def _put(self, email: str, blob: bytes) -> None:
+        path, *stale = self._paths_for(email)
+        self._write_atomic(path, blob)
+        for stale_path in stale:
+            self._unlink(stale_path)
+
+    def compare_and_set(self, email: str, expected: Optional[bytes], blob: bytes) -> bool:
+        with self.record_lock(email):
+            if self.get(email) != expected:
+                return False
+            self._put(email, blob)
+            return True
+
+    @staticmethod
+    def _unlink(path: Path) -> bool:
+        try:
+            path.unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+    def delete(self, email: str) -> bool:
+        with self.record_lock(email):
+            deleted = False
+            for path in self._paths_for(email):
+                deleted = self._unlink(path) or deleted
+            return deleted
+
+    def exists(self, email: str) -> bool:
+        return any(path.exists() for path in self._paths_for(email))
+
+    def _iter_files(self) -> Iterator[Path]:
+        if not self.root.exists():
+            return
+        if self.layout == "flat" or self.legacy_fallback:
+            yield from self.root.glob("*.json")
+        if self.layout == "sharded":
+            yield from self.root.glob("[0-9a-f][0-9a-f]/[0-9a-f][0-9a-f]/*.json")
+
+    def iter_emails(self, after: Optional[str] = None) -> Iterator[str]:
+        emails = {self.email_for(path.name) for path in self._iter_files()}
+        for email in sorted(emails):
+            if after is None or email > after:
+                yield email
+
+    def reshard(self) -> dict:
+        """Move every flat-layout file into its shard, safe to run while serving.
+
+        A record already present in its shard was written by the API after
+        the move started and wins; the stale flat copy is just removed. Each
+        move holds the record lock, so a delete can't run between reading the
+        flat file and linking the copy into place and then be undone by it.
+        """
+        if self.layout != "sharded":
+            raise ValueError("reshard needs the sharded layout")
+        stats = {"moved": 0, "superseded": 0}
+        for path in list(self.root.glob("*.json")):
+            email = self.email_for(path.name)
+            with self.record_lock(email):
+                try:
+                    with open(path, "rb") as f:
+                        blob = f.read()
+                except FileNotFoundError:
+                    continue
+                if self._write_atomic(self.sharded_path_for(email), blob, replace=False):
+                    stats["moved"] += 1
+                else:
+                    stats["superseded"] += 1
+                self._unlink(path)
+        return stats
+
+    def compact(self, max_tmp_age: float = 3600.0) -> dict:
+        """Remove temp files left by crashed writers and empty shard directories"""
+        stats = {"tmp_removed": 0, "dirs_removed": 0}
+        if not self.root.exists():
+            return stats
+        cutoff = time.time() - max_tmp_age
+        for tmp_path in self.root.rglob(".*.tmp"):
+            try:
+                if tmp_path.stat().st_mtime < cutoff:
+                    tmp_path.unlink()
+                    stats["tmp_removed"] += 1
+            except FileNotFoundError:
+                continue
+        for directory in sorted(self.root.glob("*/*"), reverse=True) + sorted(self.root.glob("*")):
+            if directory.is_dir():
+                try:
+                    directory.rmdir()
+                    stats["dirs_removed"] += 1
+                except OSError:
+                    continue
+        return stats
+
+
+class SQLiteUserStore(UserStore):
+    """Encrypted rows in a single SQLite database running in WAL mode"""
+
+    def __init__(self, path="data/users.db", pool_size=4, batch_size=500, timeout=30.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS users (
+                    email TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    updated_at REAL NOT NULL
+                ) WITHOUT ROWID"""
+            )
+            conn.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=self.timeout, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=%d" % int(self.timeout * 1000))
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.get(timeout=self.timeout)
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
+
+    def get(self, email: str) -> Optional[bytes]:
+        with self._connection() as conn:
+            row = conn.execute("SELECT data FROM users WHERE email = ?", (email,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put(self, email: str, blob: bytes) -> None:
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO users (email, data, updated_at) VALUES (?, ?, ?)",
+                (email, blob, time.time()),
+            )
+            conn.commit()
+
+    def put_many(self, items: Iterable[Tuple[str, bytes]]) -> int:
+        """Write records in transactions of batch_size rows each"""
+        count = 0
+        batch = []
+        with self._connection() as conn:
+            for email, blob in items:
+                batch.append((email, blob, time.time()))
+                if len(batch) >= self.batch_size:
+                    count += self._commit_batch(conn, batch)
+                    batch = []
+            if batch:
+                count += self._commit_batch(conn, batch)
+        return count
+
+    def _commit_batch(self, conn, batch) -> int:
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (email, data, updated_at) VALUES (?, ?, ?)",
+            batch,
+        )
+        conn.commit()
+        return len(batch)
+
+    def delete(self, email: str) -> bool:
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM users WHERE email = ?", (email,))
+            conn.commit()
+        return cursor.rowcount > 0
+
+    def exists(self, email: str) -> bool:
+        with self._connection() as conn:
+            row = conn.execute("SELECT 1 FROM users WHERE email = ?", (email,)).fetchone()
+        return row is not None
+
+    def compare_and_set(self, email: str, expected: Optional[bytes], blob: bytes) -> bool:
+        with self._connection() as conn:
+            if expected is None:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO users (email, data, updated_at) VALUES (?, ?, ?)",
+                    (email, blob, time.time()),
+                )
+            else:
+                cursor = conn.execute(
+                    "UPDATE users SET data = ?, updated_at = ? WHERE email = ? AND data = ?",
+                    (blob, time.time(), email, expected),
+                )
+            conn.commit()
+        return cursor.rowcount > 0
+
+    def iter_emails(self, after: Optional[str] = None) -> Iterator[str]:
+        last = after or ""
+        while True:
+            with self._connection() as conn:
+                rows = conn.execute(
+                    "SELECT email FROM users WHERE email > ? ORDER BY email LIMIT ?",
+                    (last, self.batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            for (email,) in rows:
+                yield email
+            last = rows[-1][0]
+
+    def iter_records(self) -> Iterator[Tuple[str, bytes]]:
+        with self._connection() as conn:
+            cursor = conn.execute("SELECT email, data FROM users ORDER BY email")
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for email, data in rows:
+                    yield email, bytes(data)
+
+    def count(self) -> int:
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def create_user_store(backend: Optional[str] = None) -> UserStore:
+    """Build the backend selected by USER_STORE (file or sqlite)"""
+    backend = (backend or os.getenv("USER_STORE", "file")).lower()
+    if backend == "file":
+        return FileUserStore(
+            os.getenv("USER_DATA_DIR", "data/users"),
+            layout=os.getenv("USER_DATA_LAYOUT", "sharded"),
+            legacy_fallback=os.getenv("USER_DATA_LEGACY_FALLBACK", "1") == "1",
+        )
+    if backend == "sqlite":
+        return SQLiteUserStore(
+            os.getenv("USER_DB_PATH", "data/users.db"),
+            pool_size=int(os.getenv("USER_DB_POOL_SIZE", "4")),
+            batch_size=int(os.getenv("USER_DB_BATCH_SIZE", "500")),
+        )
+    raise ValueError(f"Unknown USER_STORE backend: {backend}")
+
+
+def migrate(source: UserStore, dest: UserStore, unreadable: Optional[List[str]] = None) -> int:
+    """Bulk-copy every record from one backend into another.
+
+    Emails the source lists but can't read are appended to ``unreadable``.
+    """
+    return dest.put_many(source.iter_records(unreadable))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="User record storage tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Import an existing data/users tree into SQLite"
+    )
+    migrate_parser.add_argument("--src", default="data/users")
+    migrate_parser.add_argument("--db", default="data/users.db")
+    migrate_parser.add_argument("--batch-size", type=int, default=500)
+
+    reshard_parser = subparsers.add_parser(
+        "reshard", help="Move a flat data/users tree into the sharded layout (online)"
+    )
+    reshard_parser.add_argument("--root", default="data/users")
+    reshard_parser.add_argument("--compact", action="store_true",
+                                help="Also remove stale temp files and empty directories")
+
+    args = parser.parse_args()
+    if args.command == "reshard":
+        start = time.time()
+        file_store = FileUserStore(args.root, layout="sharded")
+        result = file_store.reshard()
+        if args.compact:
+            result.update(file_store.compact())
+        print(f"Resharded {args.root} in {time.time() - start:.2f}s: {result}")
+    elif args.command == "migrate":
+        start = time.time()
+        src_store = FileUserStore(args.src)
+        db_store = SQLiteUserStore(args.db, batch_size=args.batch_size)
+        unreadable = []
+        migrated = migrate(src_store, db_store, unreadable)
+        db_store.close()
+        print(f"Migrated {migrated} users from {args.src} to {args.db} in {time.time() - start:.2f}s")
+        if unreadable:
+            print(f"Could not read {len(unreadable)} users: {', '.join(unreadable)}")
+            raise SystemExit(1)
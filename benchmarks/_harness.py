@@ -0,0 +1,83 @@
+"""Helpers shared by the benchmark scripts.
+
+``load_app`` imports api/main.py in a fresh temporary directory,
+``serve_app`` runs it under uvicorn on a free port inside the current event
+loop, and ``client_process`` is a spawned process for HTTP clients so they
+don't compete with the server for the GIL.
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_app(name, **env):
+    """Import api/main.py from a new temp directory; ``env`` sets defaults"""
+    os.chdir(tempfile.mkdtemp(prefix=f"{name}_"))
+    if not os.getenv("ENCRYPTION_KEY"):
+        from cryptography.fernet import Fernet
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, str(API_DIR))
+    import main
+    return main
+
+
+@asynccontextmanager
+async def serve_app(app):
+    """Run ``app`` under uvicorn until the block exits; yields its base URL"""
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+@asynccontextmanager
+async def client_process():
+    """A one-process pool for client code, already spawned when yielded"""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        await asyncio.get_running_loop().run_in_executor(pool, time.time)  # spawn before timing
+        yield pool
+
+
+async def probe_loop(stop, lags, interval=0.01):
+    """Append how late each ``interval`` sleep wakes up until ``stop`` is set"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - start - interval))
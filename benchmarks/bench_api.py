@@ -0,0 +1,179 @@
+"""End-to-end load test of the preferences API.
+
+Runs api/main.py in-process under uvicorn with a seeded synthetic user
+population, then drives the user flow from a client process: POST /token,
+``--iterations`` rounds of GET + PUT /preferences, then POST /export-data.
+``--concurrency`` client threads each work through users one at a time.
+Reports throughput and p50/p95/p99 latency per operation as JSON, so
+storage, codec and crypto changes can be compared run over run:
+
+    python benchmarks/bench_api.py --users 500 --concurrency 32 --output before.json
+    USER_STORE=sqlite python benchmarks/bench_api.py --users 500 --output after.json
+
+Logins use BCRYPT_ROUNDS (4 here unless set) so bcrypt doesn't dominate;
+bench_login.py measures login throughput on its own. Failed requests are
+counted per status code, e.g. 503 for logins shed beyond LOGIN_MAX_PENDING.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _harness import client_process, load_app, percentile, serve_app
+
+PASSWORD = "correct horse battery staple"
+OPERATIONS = ("token", "get_preferences", "put_preferences", "export")
+COOKIE_PREFERENCES = ("essential", "functional", "analytics", "all")
+
+
+def random_preferences(rng):
+    return {
+        "marketing_emails": rng.random() < 0.3,
+        "product_updates": rng.random() < 0.7,
+        "security_alerts": True,
+        "analytics_consent": rng.random() < 0.4,
+        "personalization": rng.random() < 0.5,
+        "cookie_preference": rng.choice(COOKIE_PREFERENCES),
+        "essential_cookies": True,
+        "analytics_cookies": rng.random() < 0.4,
+        "marketing_cookies": rng.random() < 0.2,
+        "functional_cookies": rng.random() < 0.5,
+    }
+
+
+def seed_users(main, count, seed):
+    """Credentials and a stored preferences record for each synthetic user"""
+    from auth import hash_password
+    password_hash = hash_password(PASSWORD)
+    rng = random.Random(seed)
+    emails = [f"load{i}@example.com" for i in range(count)]
+    for email in emails:
+        main.credential_store.set(email, password_hash)
+        main.save_preferences(email, main.UserPreferences(**random_preferences(rng)))
+    return emails
+
+
+def user_flow(session, url, email, rng, iterations, stream_export, record):
+    def timed(operation, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, f"{url}{path}", timeout=60, **kwargs)
+            response.content  # read streamed bodies fully
+            outcome = response.status_code
+        except Exception as exc:
+            response, outcome = None, type(exc).__name__
+        record(operation, time.perf_counter() - start, outcome)
+        return response if outcome == 200 else None
+
+    response = timed("token", "POST", "/token", data={"username": email, "password": PASSWORD})
+    if response is None:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    for _ in range(iterations):
+        timed("get_preferences", "GET", "/preferences", headers=headers)
+        timed("put_preferences", "PUT", "/preferences", headers=headers,
+              json=random_preferences(rng))
+    params = {"stream": "true"} if stream_export else {}
+    timed("export", "POST", "/export-data", headers=headers, params=params)
+
+
+def run_clients(url, emails, concurrency, iterations, stream_export, seed):
+    import requests
+
+    latencies = {operation: [] for operation in OPERATIONS}
+    errors = {operation: {} for operation in OPERATIONS}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def record(operation, seconds, outcome):
+        with lock:
+            if outcome == 200:
+                latencies[operation].append(seconds)
+            else:
+                counts = errors[operation]
+                counts[str(outcome)] = counts.get(str(outcome), 0) + 1
+
+    def run_user(index):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        rng = random.Random(seed + index)
+        user_flow(local.session, url, emails[index], rng, iterations, stream_export, record)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        list(clients.map(run_user, range(len(emails))))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def run(main, args, emails):
+    loop = asyncio.get_running_loop()
+    async with serve_app(main.app) as url, client_process() as clients:
+        return await loop.run_in_executor(
+            clients, run_clients, url, emails,
+            args.concurrency, args.iterations, args.stream_export, args.seed,
+        )
+
+
+def summarize(latencies, errors, elapsed):
+    operations = {}
+    for operation in OPERATIONS:
+        values = latencies[operation]
+        operations[operation] = {
+            "count": len(values),
+            "errors": errors[operation],  # by status code or exception
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+        }
+    total = sum(len(values) for values in latencies.values())
+    return operations, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--iterations", type=int, default=5,
+                        help="GET + PUT /preferences rounds per user")
+    parser.add_argument("--stream-export", action="store_true",
+                        help="Use the streamed (gzip) export instead of the JSON response")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", help="Free-form label stored with the results")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module = load_app("bench_api", RATE_LIMIT_ENABLED="0", BCRYPT_ROUNDS="4")
+    emails = seed_users(app_module, args.users, args.seed)
+    # The app's lifespan hook closes the stores when the server stops
+    latencies, errors, elapsed = asyncio.run(run(app_module, args, emails))
+
+    operations, total = summarize(latencies, errors, elapsed)
+    result = {
+        "label": args.label,
+        "user_store": os.getenv("USER_STORE", "file"),
+        "bcrypt_rounds": int(os.environ["BCRYPT_ROUNDS"]),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "iterations": args.iterations,
+        "stream_export": args.stream_export,
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(sum(counts.values()) for counts in errors.values()),
+        "throughput_rps": round(total / elapsed, 1),
+        "operations": operations,
+    }
+    print(json.dumps(result, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
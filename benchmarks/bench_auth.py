@@ -0,0 +1,69 @@
+"""Per-request auth overhead: inline jwt.decode versus the cached resolver.
+
+    python benchmarks/bench_auth.py --iterations 20000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from _harness import load_app
+
+
+def bench_inline_decode(main, token, iterations):
+    """What every endpoint did before: decode + sub extraction per request"""
+    from jose import jwt
+    secret_key = main.get_secret_key()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        payload = jwt.decode(token, secret_key, algorithms=[main.ALGORITHM])
+        email = payload.get("sub")
+        assert email
+    return time.perf_counter() - start
+
+
+async def bench_resolver(main, tokens, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        await main.get_token_claims(tokens[i % len(tokens)])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=100,
+                        help="Distinct tokens cycled through by the cached resolver")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module = load_app("bench_auth")
+    tokens = [
+        app_module.create_access_token({"sub": f"bench{i}@example.com"})
+        for i in range(args.users)
+    ]
+
+    inline = bench_inline_decode(app_module, tokens[0], args.iterations)
+
+    app_module.token_cache.clear()
+    cold = asyncio.run(bench_resolver(app_module, tokens, len(tokens)))
+    warm = asyncio.run(bench_resolver(app_module, tokens, args.iterations))
+
+    results = {
+        "iterations": args.iterations,
+        "inline_decode_us": round(inline / args.iterations * 1e6, 2),
+        "resolver_cold_us": round(cold / len(tokens) * 1e6, 2),
+        "resolver_warm_us": round(warm / args.iterations * 1e6, 2),
+        "speedup": round(inline / warm, 1) if warm else None,
+        "token_cache": app_module.token_cache.stats(),
+    }
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
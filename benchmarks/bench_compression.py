@@ -0,0 +1,144 @@
+"""CPU cost vs bytes saved for response compression levels.
+
+Captures real response bodies from api/main.py (a user export, an admin batch
+NDJSON response, the /metrics page) with compression turned off, then
+compresses each with gzip levels 1-9 and, when brotli is installed, brotli
+qualities 0-11. Streamed bodies are also compressed the way
+CompressionMiddleware sends them (a flush after every chunk) to show what
+per-chunk flushing costs in ratio.
+
+    python benchmarks/bench_compression.py --batch-lines 2000 --output compression.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from _harness import load_app
+
+
+def load_uncompressed_app():
+    os.environ["COMPRESSION_ENABLED"] = "0"
+    return load_app(
+        "bench_compression", RATE_LIMIT_ENABLED="0", BCRYPT_ROUNDS="4", LOGIN_HASH_MODE="inline"
+    )
+
+
+async def asgi_body_chunks(app, method, path, headers, body):
+    """Call the app directly: the test client joins streamed chunks"""
+    chunks = []
+    scope = {
+        "type": "http", "http_version": "1.1", "method": method, "path": path,
+        "raw_path": path.encode(), "query_string": b"", "root_path": "", "scheme": "http",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 80),
+    }
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"])
+
+    await app(scope, receive, send)
+    return chunks
+
+
+def capture_payloads(main, batch_lines):
+    """Response bodies as lists of the chunks the app sent"""
+    from auth import hash_password
+    from fastapi.testclient import TestClient
+
+    main.credential_store.set("bench@example.com", hash_password("pw"), ["admin"])
+    with TestClient(main.app) as client:
+        token = client.post(
+            "/token", data={"username": "bench@example.com", "password": "pw", "scope": "admin"}
+        ).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": "identity"}
+        client.put("/preferences", headers=headers, json={"marketing_emails": True})
+        batch = "".join(
+            json.dumps({"email": f"user{i}@example.com", "preferences": {"analytics_consent": i % 2 == 0}}) + "\n"
+            for i in range(batch_lines)
+        )
+        payloads = {}
+        payloads["batch_ndjson"] = asyncio.run(asgi_body_chunks(
+            main.app, "POST", "/admin/preferences/batch", headers, batch.encode()
+        ))
+        payloads["export_json"] = [client.post("/export-data", headers=headers).content]
+        payloads["metrics_text"] = [client.get("/metrics", headers=headers).content]
+    return payloads
+
+
+def encoders():
+    from compression import BrotliEncoder, GzipEncoder, brotli
+
+    for level in range(1, 10):
+        yield "gzip", level, lambda level=level: GzipEncoder(level)
+    if brotli is not None:
+        for quality in range(0, 12):
+            yield "br", quality, lambda quality=quality: BrotliEncoder(quality)
+
+
+def measure(make_encoder, chunks, flush_each, repeat):
+    size = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encoder = make_encoder()
+        size = 0
+        for chunk in chunks:
+            size += len(encoder.compress(chunk))
+            if flush_each:
+                size += len(encoder.flush())
+        size += len(encoder.finish())
+    return size, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-lines", type=int, default=1000)
+    parser.add_argument("--min-seconds", type=float, default=0.2,
+                        help="Repeat each measurement for at least this long")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    payloads = capture_payloads(load_uncompressed_app(), args.batch_lines)
+    results = []
+    for name, chunks in payloads.items():
+        original = sum(len(chunk) for chunk in chunks)
+        modes = [False, True] if len(chunks) > 1 else [False]
+        for coding, level, make_encoder in encoders():
+            for flush_each in modes:
+                _, once = measure(make_encoder, chunks, flush_each, 1)
+                repeat = max(1, int(args.min_seconds / max(once, 1e-6)))
+                size, seconds = measure(make_encoder, chunks, flush_each, repeat)
+                result = {
+                    "payload": name,
+                    "original_bytes": original,
+                    "chunks": len(chunks),
+                    "coding": coding,
+                    "level": level,
+                    "flush_per_chunk": flush_each,
+                    "compressed_bytes": size,
+                    "ratio": round(size / original, 4),
+                    "saved_bytes": original - size,
+                    "cpu_ms": round(seconds * 1000, 3),
+                    "mb_per_s": round(original / seconds / 1e6, 1),
+                }
+                results.append(result)
+                print(json.dumps(result))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
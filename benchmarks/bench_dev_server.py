@@ -0,0 +1,193 @@
+"""Page-load latency of the dev server (server.py) with parallel asset fetches.
+
+Serves the site from server.py on a free port and loads a page the way a
+browser does: fetch the HTML, then fetch its local stylesheets, scripts and
+images over ``--connections`` parallel keep-alive connections. Compares:
+
+- ``serial``: the old single-connection server (``socketserver.TCPServer``,
+  HTTP/1.0, a new connection per request)
+- ``pooled``: PooledHTTPServer with HTTP/1.1 keep-alive
+
+``--stalled N`` first opens N connections that never send a request (a hung
+browser socket); the serial server can't serve anything else until they
+time out.
+
+    python benchmarks/bench_dev_server.py --page index.html --loads 50 --stalled 1
+"""
+import argparse
+import functools
+import http.client
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from pathlib import Path
+
+from _harness import free_port, percentile
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class AssetParser(HTMLParser):
+    """Local stylesheet, script and image URLs of a page"""
+
+    def __init__(self):
+        super().__init__()
+        self.assets = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "link" and "stylesheet" in (attrs.get("rel") or ""):
+            url = attrs.get("href")
+        elif tag in ("script", "img"):
+            url = attrs.get("src")
+        else:
+            return
+        if url and "//" not in url and not url.startswith("data:"):
+            self.assets.append("/" + url.lstrip("/"))
+
+
+def page_assets(page):
+    parser = AssetParser()
+    parser.feed((ROOT / page).read_text(encoding="utf-8"))
+    return list(dict.fromkeys(parser.assets))
+
+
+def start(mode, port):
+    sys.path.insert(0, str(ROOT))
+    import server
+
+    if mode == "serial":
+        class Handler(server.CORSRequestHandler):
+            protocol_version = "HTTP/1.0"
+            timeout = None
+
+        httpd = socketserver.TCPServer(
+            ("127.0.0.1", port), functools.partial(Handler, directory=str(ROOT))
+        )
+    else:
+        handler = functools.partial(server.CORSRequestHandler, directory=str(ROOT))
+        httpd = server.PooledHTTPServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
+class Connection:
+    """One keep-alive client connection, reconnecting when the server closes it"""
+
+    def __init__(self, port, timeout):
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def get(self, path):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+            try:
+                self.conn.request("GET", path)
+                response = self.conn.getresponse()
+                body = response.read()
+                if response.will_close:
+                    self.close()
+                return response.status, len(body)
+            except (ConnectionError, http.client.HTTPException):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def load_page(connections, page, assets, pool):
+    start = time.perf_counter()
+    connections[0].get("/" + page)
+    slots = list(range(len(connections)))
+    lock = threading.Lock()
+
+    def fetch(path):
+        with lock:
+            slot = slots.pop()
+        try:
+            return connections[slot].get(path)
+        finally:
+            with lock:
+                slots.append(slot)
+
+    list(pool.map(fetch, assets))
+    return time.perf_counter() - start
+
+
+def run_mode(mode, page, assets, loads, connection_count, stalled, timeout):
+    port = free_port()
+    httpd = start(mode, port)
+    hung = [socket.create_connection(("127.0.0.1", port)) for _ in range(stalled)]
+    connections = [Connection(port, timeout) for _ in range(connection_count)]
+    latencies, errors = [], 0
+    try:
+        with ThreadPoolExecutor(max_workers=connection_count) as pool:
+            for _ in range(loads):
+                try:
+                    latencies.append(load_page(connections, page, assets, pool))
+                except OSError:
+                    errors += 1
+                    for connection in connections:
+                        connection.close()
+    finally:
+        for sock in hung:
+            sock.close()
+        for connection in connections:
+            connection.close()
+        httpd.shutdown()
+        httpd.server_close()
+    return {
+        "mode": mode,
+        "page": page,
+        "assets": len(assets),
+        "loads": loads,
+        "connections": connection_count,
+        "stalled_connections": stalled,
+        "errors": errors,
+        "page_load_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "page_load_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "page_load_max_ms": round(max(latencies) * 1000, 2) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page", default="index.html")
+    parser.add_argument("--loads", type=int, default=50)
+    parser.add_argument("--connections", type=int, default=6,
+                        help="Parallel connections per page load (browsers use 6)")
+    parser.add_argument("--stalled", type=int, default=0,
+                        help="Idle connections opened before loading pages")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="Client timeout per request")
+    parser.add_argument("--modes", default="serial,pooled")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    assets = page_assets(args.page)
+    results = []
+    for mode in args.modes.split(","):
+        result = run_mode(mode, args.page, assets, args.loads, args.connections,
+                          args.stalled, args.timeout)
+        results.append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
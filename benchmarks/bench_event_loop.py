@@ -0,0 +1,120 @@
+"""Event loop responsiveness under concurrent PUT /preferences.
+
+Runs api/main.py in-process under uvicorn, fires N concurrent PUTs from a
+client thread pool in a separate process (so clients don't compete for the
+server's GIL) and samples how late a 10 ms timer on the server's event
+loop fires. In ``inline`` mode storage and crypto block the loop; in
+``threadpool`` mode only request parsing and JWT checks remain on the loop,
+so the lag should drop by an order of magnitude.
+
+    python benchmarks/bench_event_loop.py --concurrency 200 --io-delay 0.005
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _harness import client_process, load_app, percentile, probe_loop, serve_app
+
+
+class SlowStore:
+    """Wraps a store and adds a fixed delay to every call (simulated slow disk)"""
+
+    def __init__(self, store, delay):
+        self.store = store
+        self.delay = delay
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        def slow(*args, **kwargs):
+            time.sleep(self.delay)
+            return attr(*args, **kwargs)
+        return slow
+
+
+def put_preferences(url, token):
+    import requests
+    start = time.perf_counter()
+    response = requests.put(
+        f"{url}/preferences",
+        json={"marketing_emails": True, "analytics_consent": True},
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=60,
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run_clients(url, tokens, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        return list(clients.map(lambda token: put_preferences(url, token), tokens))
+
+
+async def run_mode(main, mode, concurrency, requests_total):
+    main.BLOCKING_IO_MODE = mode
+    tokens = [
+        main.create_access_token({"sub": f"bench{i}@example.com"})
+        for i in range(requests_total)
+    ]
+    stop = asyncio.Event()
+    lags = []
+    loop = asyncio.get_running_loop()
+    async with serve_app(main.app) as url:
+        async with client_process() as clients:
+            probe = asyncio.create_task(probe_loop(stop, lags))
+            start = time.perf_counter()
+            latencies = await loop.run_in_executor(
+                clients, run_clients, url, tokens, concurrency
+            )
+            elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    return {
+        "mode": mode,
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests_total / elapsed, 1),
+        "request_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "request_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "loop_lag_mean_ms": round(statistics.mean(lags) * 1000, 2) if lags else 0.0,
+        "loop_lag_p99_ms": round(percentile(lags, 99) * 1000, 2),
+        "loop_lag_max_ms": round(max(lags) * 1000, 2) if lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--io-delay", type=float, default=0.005,
+                        help="Seconds of simulated disk latency per storage call")
+    parser.add_argument("--modes", default="inline,threadpool")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module = load_app("bench_event_loop", RATE_LIMIT_ENABLED="0")
+    if args.io_delay:
+        app_module.user_store = SlowStore(app_module.user_store, args.io_delay)
+
+    results = []
+    for mode in args.modes.split(","):
+        result = asyncio.run(run_mode(app_module, mode, args.concurrency, args.requests))
+        results.append(result)
+        print(json.dumps(result))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Login throughput with bcrypt inline vs in a process pool.
+
+Runs api/main.py in-process under uvicorn, seeds users with a bcrypt hash at
+BCRYPT_ROUNDS, then fires concurrent POST /token requests from a client
+process. In ``inline`` mode every bcrypt check blocks the event loop, so
+logins are serialized and the loop lag equals the hash time; in ``process``
+mode checks run on LOGIN_WORKERS processes and requests beyond
+LOGIN_MAX_PENDING are shed with 503 + Retry-After.
+
+    python benchmarks/bench_login.py --concurrency 50 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from _harness import client_process, load_app, percentile, probe_loop, serve_app
+
+PASSWORD = "correct horse battery staple"
+
+
+def login(url, username):
+    import requests
+    start = time.perf_counter()
+    response = requests.post(
+        f"{url}/token", data={"username": username, "password": PASSWORD}, timeout=300
+    )
+    return response.status_code, time.perf_counter() - start
+
+
+def run_clients(url, usernames, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        return list(clients.map(lambda username: login(url, username), usernames))
+
+
+async def run_mode(main, mode, concurrency, requests_total, usernames):
+    main.password_hasher.mode = mode
+    main.password_hasher.shed = 0
+    attempts = [usernames[i % len(usernames)] for i in range(requests_total)]
+    stop = asyncio.Event()
+    lags = []
+    loop = asyncio.get_running_loop()
+    async with serve_app(main.app) as url:
+        async with client_process() as clients:
+            if mode == "process":
+                # Start the hashing workers before timing too
+                await main.password_hasher.verify(PASSWORD, main.credential_store.get(usernames[0])[0])
+            probe = asyncio.create_task(probe_loop(stop, lags))
+            start = time.perf_counter()
+            results = await loop.run_in_executor(
+                clients, run_clients, url, attempts, concurrency
+            )
+            elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    ok = [latency for code, latency in results if code == 200]
+    codes = {}
+    for code, _ in results:
+        codes[str(code)] = codes.get(str(code), 0) + 1
+    return {
+        "mode": mode,
+        "bcrypt_rounds": int(os.getenv("BCRYPT_ROUNDS", "12")),
+        "workers": main.password_hasher.workers,
+        "max_pending": main.password_hasher.max_pending,
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "status_codes": codes,
+        "elapsed_s": round(elapsed, 3),
+        "logins_per_s": round(len(ok) / elapsed, 1),
+        "login_p50_ms": round(percentile(ok, 50) * 1000, 2),
+        "login_p99_ms": round(percentile(ok, 99) * 1000, 2),
+        "loop_lag_mean_ms": round(statistics.mean(lags) * 1000, 2) if lags else 0.0,
+        "loop_lag_p99_ms": round(percentile(lags, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--modes", default="inline,process")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    app_module = load_app("bench_login", RATE_LIMIT_ENABLED="0")
+    from auth import hash_password
+    password_hash = hash_password(PASSWORD)
+    usernames = [f"bench{i}@example.com" for i in range(args.users)]
+    for username in usernames:
+        app_module.credential_store.set(username, password_hash)
+
+    results = []
+    for mode in args.modes.split(","):
+        result = asyncio.run(run_mode(app_module, mode, args.concurrency, args.requests, usernames))
+        results.append(result)
+        print(json.dumps(result))
+    app_module.password_hasher.shutdown()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
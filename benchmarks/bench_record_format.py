@@ -0,0 +1,88 @@
+"""Bytes per user and encode/decode time: legacy JSON versus the compact codec.
+
+    python benchmarks/bench_record_format.py --users 10000
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+from cryptography.fernet import Fernet
+
+from codec import COOKIE_PREFERENCE_CODES, PREFERENCE_FLAGS, decode_user_record, encode_user_record
+
+
+def synthetic_records(count, seed):
+    rng = random.Random(seed)
+    now = datetime(2024, 1, 1)
+    records = []
+    for i in range(count):
+        preferences = {name: rng.random() < 0.5 for name in PREFERENCE_FLAGS}
+        preferences["cookie_preference"] = rng.choice(list(COOKIE_PREFERENCE_CODES))
+        stamp = (now + timedelta(seconds=rng.randrange(10 ** 7), microseconds=rng.randrange(10 ** 6)))
+        records.append({
+            "email": f"user{i}@example.com",
+            "preferences": preferences,
+            "last_access": stamp.isoformat(),
+            "last_consent_update": stamp.isoformat(),
+            "active_sessions": [],
+        })
+    return records
+
+
+def measure(fernet, records, encode, decode):
+    start = time.perf_counter()
+    tokens = [fernet.encrypt(encode(record)) for record in records]
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in tokens:
+        decode(fernet.decrypt(token))
+    decrypt_decode_time = time.perf_counter() - start
+
+    plaintexts = [encode(record) for record in records]
+    start = time.perf_counter()
+    for plaintext in plaintexts:
+        decode(plaintext)
+    decode_time = time.perf_counter() - start
+
+    count = len(records)
+    return {
+        "plaintext_bytes_per_user": round(sum(map(len, plaintexts)) / count, 1),
+        "stored_bytes_per_user": round(sum(map(len, tokens)) / count, 1),
+        "encrypt_encode_us": round(encode_time / count * 1e6, 2),
+        "decrypt_decode_us": round(decrypt_decode_time / count * 1e6, 2),
+        "decode_only_us": round(decode_time / count * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    fernet = Fernet(Fernet.generate_key())
+    records = synthetic_records(args.users, args.seed)
+    for record in records[:100]:
+        assert decode_user_record(encode_user_record(record)) == record
+
+    results = {
+        "users": args.users,
+        "json": measure(fernet, records, lambda r: json.dumps(r).encode(), json.loads),
+        "compact": measure(fernet, records, encode_user_record, decode_user_record),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""API cold start: time to import api/main.py and to run its startup hook.
+
+Each run starts a fresh interpreter with ``-X importtime`` in an empty data
+directory, imports main, then opens the stores and workers the lifespan hook
+would open. Reports the median import and startup times and the slowest
+imports by cumulative time. With ``--budget-ms`` the script exits with
+status 1 when the median import time is over budget, so CI can enforce it:
+
+    python benchmarks/bench_startup.py --runs 5 --budget-ms 500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {api_dir!r})
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.open_resources()
+opened = time.perf_counter()
+main.close_resources()
+print(json.dumps({{"import_s": imported - start, "startup_s": opened - imported}}))
+"""
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Cumulative microseconds per top-level package, from -X importtime output"""
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        package = name.strip().split(".")[0]
+        # Only count the outermost import of each package
+        if len(name) - len(name.lstrip()) <= 3:
+            totals[package] = totals.get(package, 0) + int(cumulative)
+    return totals
+
+
+def run_once(env) -> tuple:
+    with tempfile.TemporaryDirectory(prefix="bench_startup_") as workdir:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", CHILD.format(api_dir=str(API_DIR))],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="Fail if the median import time exceeds this")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if not env.get("ENCRYPTION_KEY") and not env.get("ENCRYPTION_KEYS"):
+        from cryptography.fernet import Fernet
+        env["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    env.setdefault("SECRET_KEY", "bench-startup")
+
+    imports, startups, packages = [], [], {}
+    for _ in range(args.runs):
+        timings, totals = run_once(env)
+        imports.append(timings["import_s"])
+        startups.append(timings["startup_s"])
+        for package, micros in totals.items():
+            packages.setdefault(package, []).append(micros)
+
+    slowest = sorted(
+        ((package, statistics.median(values)) for package, values in packages.items()),
+        key=lambda item: item[1],
+        reverse=True,
+    )[:args.top]
+    result = {
+        "runs": args.runs,
+        "import_median_ms": round(statistics.median(imports) * 1000, 1),
+        "import_max_ms": round(max(imports) * 1000, 1),
+        "startup_median_ms": round(statistics.median(startups) * 1000, 1),
+        "slowest_imports_ms": {package: round(micros / 1000, 1) for package, micros in slowest},
+        "budget_ms": args.budget_ms,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.budget_ms is not None and result["import_median_ms"] > args.budget_ms:
+        print(f"Import time {result['import_median_ms']} ms is over the {args.budget_ms} ms budget",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -96,7 +96,7 @@ Date: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
    - Update SSL certificates
    - Configure firewall rules
    - Set secure permissions
-   - Enable rate limiting
+   - Review API rate limits (RATE_LIMITS, see README)
 
 6. Monitoring
    - Check server logs
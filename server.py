@@ -1,8 +1,17 @@
+import base64
+import email.utils
+import fnmatch
+import hashlib
 import http.server
-import socketserver
 import os
+import re
+import selectors
+import struct
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import webbrowser
@@ -11,42 +20,431 @@ from threading import Thread
 PORT = 8000
 DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
+# Connections are served on a bounded thread pool with HTTP/1.1 keep-alive.
+# Idle or stalled connections are dropped after KEEP_ALIVE_TIMEOUT seconds, so
+# a hung browser socket ties up one worker for a while instead of the server.
+MAX_WORKERS = int(os.getenv('DEV_SERVER_WORKERS', '16'))
+KEEP_ALIVE_TIMEOUT = float(os.getenv('DEV_SERVER_KEEP_ALIVE', '5'))
+
+# Production static mode (python server.py --static) serves the build in dist/
+# from a bounded in-memory cache, with the .gz files the build writes next to
+# each asset. Hashed names (app.3f9a2c1b.js) never change, so they are cached
+# by browsers for a year; everything else is revalidated with its ETag.
+DIST_DIRECTORY = os.path.join(DIRECTORY, 'dist')
+STATIC_CACHE_MAX_BYTES = int(os.getenv('STATIC_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+STATIC_CACHE_MAX_FILE_BYTES = int(os.getenv('STATIC_CACHE_MAX_FILE_BYTES', str(4 * 1024 * 1024)))
+HASHED_NAME = re.compile(r'[.-][0-9a-fA-F]{8,}\.[A-Za-z0-9]+$')
+
+# Live reload: file changes are collected for DEBOUNCE_SECONDS and then
+# announced to every page on /ws, either as 'reload' or, when only
+# stylesheets changed, as 'css:<path>' so the page swaps them in place.
+WATCHED_EXTENSIONS = ('.html', '.css', '.js', '.svg')
+IGNORE_PATTERNS = ('.git', 'dist', 'reports', 'node_modules', '__pycache__', '*.swp', '*~', '.#*')
+DEBOUNCE_SECONDS = float(os.getenv('DEV_SERVER_DEBOUNCE', '0.2'))
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
 # HTML injection for auto-reload
 RELOAD_SCRIPT = """
     <script>
-        let socket = new WebSocket('ws://' + window.location.host + '/ws');
-        socket.onmessage = function(event) {
-            if (event.data === 'reload') window.location.reload();
-        };
-        socket.onclose = function() {
-            console.log('WebSocket closed, attempting to reconnect...');
-            setTimeout(() => {
-                window.location.reload();
-            }, 1000);
-        };
+        (function() {
+            let reconnecting = false;
+            function swapStylesheet(path) {
+                let links = document.querySelectorAll('link[rel="stylesheet"]');
+                let local = Array.from(links).filter(link => new URL(link.href).host === window.location.host);
+                let matching = local.filter(link => new URL(link.href).pathname === path);
+                (matching.length ? matching : local).forEach(link => {
+                    let url = new URL(link.href);
+                    url.searchParams.set('livereload', Date.now());
+                    link.href = url.toString();
+                });
+            }
+            function connect() {
+                let socket = new WebSocket('ws://' + window.location.host + '/ws');
+                socket.onopen = function() {
+                    // The server restarted while we were away: pick up its changes
+                    if (reconnecting) window.location.reload();
+                };
+                socket.onmessage = function(event) {
+                    if (event.data === 'reload') window.location.reload();
+                    else if (event.data.startsWith('css:')) swapStylesheet(event.data.slice(4));
+                };
+                socket.onclose = function() {
+                    console.log('WebSocket closed, attempting to reconnect...');
+                    reconnecting = true;
+                    setTimeout(connect, 1000);
+                };
+            }
+            connect();
+        })();
     </script>
 </body>
 """
 
+# Pages with the reload script spliced in, by file path, valid while the
+# file's (mtime, size) is unchanged. Only the site's HTML files end up here.
+html_cache = {}
+html_cache_lock = threading.Lock()
+
+def inject_reload_script(content):
+    index = content.lower().rfind(b'</body>')
+    if index == -1:
+        return content + RELOAD_SCRIPT.encode('utf-8')
+    return content[:index] + RELOAD_SCRIPT.encode('utf-8') + content[index + len(b'</body>'):]
+
+def load_html(path):
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with html_cache_lock:
+        cached = html_cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1], stat
+    with open(path, 'rb') as f:
+        content = inject_reload_script(f.read())
+    with html_cache_lock:
+        html_cache[path] = (version, content)
+    return content, stat
+
+def websocket_frame(text):
+    payload = text.encode('utf-8')
+    if len(payload) < 126:
+        header = struct.pack('!BB', 0x81, len(payload))
+    elif len(payload) < 65536:
+        header = struct.pack('!BBH', 0x81, 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', 0x81, 127, len(payload))
+    return header + payload
+
+class ReloadHub:
+    """Open /ws connections; one thread watches them for close frames"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.clients = set()
+        self.thread = None
+
+    def add(self, sock):
+        sock.settimeout(1)
+        with self.lock:
+            self.clients.add(sock)
+            self.selector.register(sock, selectors.EVENT_READ)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.watch, daemon=True)
+                self.thread.start()
+
+    def remove(self, sock):
+        with self.lock:
+            if sock not in self.clients:
+                return
+            self.clients.discard(sock)
+            self.selector.unregister(sock)
+        try:
+            sock.sendall(b'\x88\x00')
+        except OSError:
+            pass
+        sock.close()
+
+    def broadcast(self, message):
+        frame = websocket_frame(message)
+        with self.lock:
+            clients = list(self.clients)
+        for sock in clients:
+            try:
+                sock.sendall(frame)
+            except OSError:
+                self.remove(sock)
+        return len(clients)
+
+    def watch(self):
+        while True:
+            with self.lock:
+                has_clients = bool(self.clients)
+            if not has_clients:
+                time.sleep(0.5)
+                continue
+            for key, _ in self.selector.select(timeout=0.5):
+                try:
+                    data = key.fileobj.recv(4096)
+                except OSError:
+                    data = b''
+                # Clients only ever send close (and maybe ping) frames
+                if not data or data[0] & 0x0F == 0x8:
+                    self.remove(key.fileobj)
+
+hub = ReloadHub()
+
 class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def end_headers(self):
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    # Headers and body go out in separate writes; with Nagle on, each
+    # keep-alive response waits for the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET')
+
+    def end_headers(self):
+        self.send_cors_headers()
         self.send_header('Cache-Control', 'no-store, no-cache, must-revalidate')
         return super().end_headers()
 
     def do_GET(self):
+        if self.path == '/ws':
+            return self.open_websocket()
         # Serve index.html for root path
         if self.path == '/':
             self.path = '/index.html'
-        super().do_GET()
-        if self.path.endswith('.html'):
-            content = self.wfile.getvalue().decode('utf-8')
-            modified_content = content.replace('</body>', RELOAD_SCRIPT)
-            self.wfile = type(self.wfile)(modified_content.encode('utf-8'))
-
-def start_server():
-    with socketserver.TCPServer(("", PORT), CORSRequestHandler) as httpd:
+        if not self.send_html():
+            super().do_GET()
+
+    def do_HEAD(self):
+        if self.path == '/':
+            self.path = '/index.html'
+        if not self.send_html(head_only=True):
+            super().do_HEAD()
+
+    def send_html(self, head_only=False):
+        """Serve an HTML page with the reload script; False if path isn't one"""
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if not path.endswith(('.html', '.htm')) or not os.path.isfile(path):
+            return False
+        try:
+            content, stat = load_html(path)
+        except OSError:
+            self.send_error(404, 'File not found')
+            return True
+        self.send_response(200)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(content)
+        return True
+
+    def open_websocket(self):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_error(400, 'Expected a WebSocket upgrade')
+            return
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+        self.wfile.flush()
+        # The hub owns the socket from here on; this worker is free again
+        self.close_connection = True
+        self.server.detach(self.connection)
+        hub.add(self.connection)
+
+class StaticAsset:
+    __slots__ = ('version', 'body', 'gzip_body', 'etag', 'last_modified', 'content_type')
+
+    def __init__(self, version, body, gzip_body, mtime, content_type):
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip_body
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.etag = f'"{digest}"'
+        self.last_modified = mtime
+        self.content_type = content_type
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.gzip_body or b'')
+
+class StaticCache:
+    """Files and their .gz variants by path, LRU-bounded by total bytes"""
+
+    def __init__(self, max_bytes=STATIC_CACHE_MAX_BYTES, max_file_bytes=STATIC_CACHE_MAX_FILE_BYTES):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        self.assets = OrderedDict()
+        self.bytes = 0
+
+    def get(self, path, content_type):
+        stat = os.stat(path)
+        try:
+            gzip_stat = os.stat(path + '.gz')
+        except OSError:
+            gzip_stat = None
+        # A .gz older than its source is left over from a previous build
+        gzip_fresh = gzip_stat is not None and gzip_stat.st_mtime_ns >= stat.st_mtime_ns
+        version = (stat.st_mtime_ns, stat.st_size, gzip_stat.st_mtime_ns if gzip_fresh else None)
+        with self.lock:
+            asset = self.assets.get(path)
+            if asset is not None and asset.version == version:
+                self.assets.move_to_end(path)
+                return asset
+        with open(path, 'rb') as f:
+            body = f.read()
+        gzip_body = None
+        if gzip_fresh:
+            with open(path + '.gz', 'rb') as f:
+                gzip_body = f.read()
+        asset = StaticAsset(version, body, gzip_body, stat.st_mtime, content_type)
+        if asset.size <= self.max_file_bytes:
+            with self.lock:
+                old = self.assets.pop(path, None)
+                if old is not None:
+                    self.bytes -= old.size
+                self.assets[path] = asset
+                self.bytes += asset.size
+                while self.bytes > self.max_bytes:
+                    _, evicted = self.assets.popitem(last=False)
+                    self.bytes -= evicted.size
+        return asset
+
+static_cache = StaticCache()
+
+def parse_accept_encoding(header):
+    """Accept-Encoding as {coding: q}, like api/compression.py"""
+    codings = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        codings[name] = q
+    return codings
+
+def accepts_gzip(header):
+    # An explicit gzip entry wins over '*', wherever each appears
+    codings = parse_accept_encoding(header)
+    return codings.get('gzip', codings.get('*', 0.0)) > 0
+
+class StaticRequestHandler(CORSRequestHandler):
+    """Serves dist/ from StaticCache with validators, no live reload"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('directory', DIST_DIRECTORY)
+        super().__init__(*args, **kwargs)
+
+    def end_headers(self):
+        # Cache-Control is set per response in send_static
+        self.send_cors_headers()
+        http.server.BaseHTTPRequestHandler.end_headers(self)
+
+    def do_GET(self):
+        self.send_static()
+
+    def do_HEAD(self):
+        self.send_static(head_only=True)
+
+    def send_static(self, head_only=False):
+        request_path = self.path.split('?', 1)[0].split('#', 1)[0]
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not request_path.endswith('/'):
+                self.send_response(301)
+                self.send_header('Location', request_path + '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return
+        try:
+            asset = static_cache.get(path, self.guess_type(path))
+        except OSError:
+            self.send_error(404, 'File not found')
+            return
+
+        use_gzip = asset.gzip_body is not None and accepts_gzip(self.headers.get('Accept-Encoding'))
+        # Each encoding is its own representation, so it gets its own tag
+        etag = asset.etag[:-1] + '-gz"' if use_gzip else asset.etag
+        if HASHED_NAME.search(os.path.basename(path)):
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+
+        if self.not_modified(asset, etag):
+            self.send_response(304)
+            self.send_validators(asset, etag, cache_control)
+            self.end_headers()
+            return
+        body = asset.gzip_body if use_gzip else asset.body
+        self.send_response(200)
+        self.send_header('Content-Type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_validators(asset, etag, cache_control)
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def send_validators(self, asset, etag, cache_control):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(asset.last_modified))
+        self.send_header('Cache-Control', cache_control)
+        if asset.gzip_body is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def not_modified(self, asset, etag):
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since is not None:
+                return int(asset.last_modified) <= since.timestamp()
+        return False
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTPServer handing each connection to a fixed-size thread pool"""
+
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dev-server')
+        self.detached = set()
+
+    def detach(self, request):
+        """Keep request's socket open after its handler returns"""
+        self.detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        super().shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+def start_server(handler_class=CORSRequestHandler):
+    with PooledHTTPServer(("", PORT), handler_class) as httpd:
         print(f"Serving at http://localhost:{PORT}")
         try:
             httpd.serve_forever()
@@ -54,14 +452,54 @@ def start_server():
             print("\nShutting down server...")
             httpd.shutdown()
 
+def is_ignored(relative_path):
+    return any(
+        fnmatch.fnmatch(part, pattern)
+        for part in relative_path.split(os.sep)
+        for pattern in IGNORE_PATTERNS
+    )
+
 class FileChangeHandler(FileSystemEventHandler):
-    def on_modified(self, event):
-        if not event.is_directory and (
-            event.src_path.endswith(('.html', '.css', '.js', '.svg'))
-        ):
-            print(f"File changed: {event.src_path}")
-            # In a real WebSocket implementation, we would send a message to all clients
-            # For now, we'll just print the change
+    """Coalesces file events and announces each batch to the reload hub"""
+
+    def __init__(self, delay=DEBOUNCE_SECONDS):
+        super().__init__()
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.timer = None
+
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ('created', 'modified', 'moved'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if not path or not path.endswith(WATCHED_EXTENSIONS):
+                continue
+            relative_path = os.path.relpath(path, DIRECTORY)
+            if is_ignored(relative_path):
+                continue
+            with self.lock:
+                self.pending.add(relative_path)
+                # Restart the window so a burst of saves is one reload
+                if self.timer is not None:
+                    self.timer.cancel()
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            changed = sorted(self.pending)
+            self.pending.clear()
+            self.timer = None
+        if not changed:
+            return
+        print(f"Files changed: {', '.join(changed)}")
+        if all(path.endswith('.css') for path in changed):
+            for path in changed:
+                hub.broadcast('css:/' + path.replace(os.sep, '/'))
+        else:
+            hub.broadcast('reload')
 
 def watch_files():
     event_handler = FileChangeHandler()
@@ -76,6 +514,11 @@ def watch_files():
     observer.join()
 
 if __name__ == "__main__":
+    if '--static' in sys.argv[1:]:
+        # Production build from dist/: cached, precompressed, no live reload
+        start_server(StaticRequestHandler)
+        sys.exit(0)
+
     # Install required package if not present
     try:
         import watchdog
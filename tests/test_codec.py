@@ -0,0 +1,89 @@
+"""On-disk format of user records (api/codec.py)."""
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+from codec import MAX_STRING_BYTES, PREFERENCE_FIELDS, decode_user_record, encode_user_record
+
+
+def make_record(**preferences):
+    defaults = {
+        "marketing_emails": False,
+        "product_updates": True,
+        "security_alerts": True,
+        "analytics_consent": False,
+        "personalization": False,
+        "cookie_preference": "essential",
+        "essential_cookies": True,
+        "analytics_cookies": False,
+        "marketing_cookies": False,
+        "functional_cookies": False,
+    }
+    defaults.update(preferences)
+    return {
+        "email": "user@example.com",
+        "preferences": defaults,
+        "last_access": "2024-03-01T12:30:45.123456",
+        "last_consent_update": "2024-02-29T08:00:00",
+        "active_sessions": [],
+    }
+
+
+@pytest.mark.parametrize("preferences", [
+    {},
+    {"marketing_emails": True, "analytics_cookies": True, "functional_cookies": True},
+    {"cookie_preference": "all"},
+    {"cookie_preference": "custom:ads=no"},
+])
+def test_round_trip(preferences):
+    record = make_record(**preferences)
+    assert decode_user_record(encode_user_record(record)) == record
+
+
+def test_round_trip_keeps_field_order_and_sessions():
+    record = make_record()
+    record["active_sessions"] = [{"id": "abc", "ip": "127.0.0.1"}]
+    decoded = decode_user_record(encode_user_record(record))
+    assert list(decoded["preferences"]) == PREFERENCE_FIELDS
+    assert decoded["active_sessions"] == record["active_sessions"]
+
+
+def test_timezone_aware_timestamps_are_stored_as_utc():
+    record = make_record()
+    record["last_access"] = "2024-03-01T14:30:45+02:00"
+    assert decode_user_record(encode_user_record(record))["last_access"] == "2024-03-01T12:30:45"
+
+
+def test_reads_legacy_json_records():
+    record = make_record(marketing_emails=True, cookie_preference="functional")
+    record["active_sessions"] = [{"id": "abc"}]
+    assert decode_user_record(json.dumps(record).encode()) == record
+
+
+def test_rejects_unknown_format_version():
+    data = bytearray(encode_user_record(make_record()))
+    data[0] = 99
+    with pytest.raises(ValueError):
+        decode_user_record(bytes(data))
+
+
+@pytest.mark.parametrize("field", ["email", "cookie_preference"])
+def test_oversized_strings_raise_value_error(field):
+    record = make_record()
+    value = "x" * (MAX_STRING_BYTES + 1)
+    if field == "email":
+        record["email"] = value
+    else:
+        record["preferences"]["cookie_preference"] = value
+    with pytest.raises(ValueError, match=field):
+        encode_user_record(record)
+
+
+def test_preference_fields_match_the_api_model():
+    from main import UserPreferences
+
+    assert PREFERENCE_FIELDS == list(UserPreferences.__fields__)
@@ -0,0 +1,130 @@
+"""Crash recovery, multi-segment queries and key rotation (api/consent_log.py)."""
+import sys
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet, MultiFernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+import consent_log
+from consent_log import ConsentLog
+
+EMAILS = ["a@x.com", "b@x.com", "c@x.com"]
+
+
+@pytest.fixture
+def key():
+    return Fernet(Fernet.generate_key())
+
+
+@pytest.fixture
+def open_log(tmp_path, key):
+    logs = []
+
+    def open_log(fernet=key, **options):
+        options.setdefault("fsync", False)
+        log = ConsentLog(tmp_path, fernet, **options)
+        logs.append(log)
+        return log
+
+    yield open_log
+    for log in logs:
+        log.close()
+
+
+def fill(log, count, emails=EMAILS):
+    events = [(emails[i % len(emails)], {"n": i}) for i in range(count)]
+    for email, preferences in events:
+        log.append(email, preferences)
+    return events
+
+
+def read_index(segment):
+    return segment.idx_path.read_bytes() if segment.idx_path.exists() else b""
+
+
+def as_pairs(events):
+    return [(event["email"], event["preferences"]) for event in events]
+
+
+def test_reopen_truncates_a_torn_tail(tmp_path, open_log):
+    log = open_log()
+    events = fill(log, 5)
+    log.close()
+    segment_path = log.segments[-1].log_path
+    size = segment_path.stat().st_size
+    with open(segment_path, "ab") as f:
+        f.write(consent_log._RECORD.pack(1e12, 1, 500) + b"half a token")
+
+    reopened = open_log()
+    assert segment_path.stat().st_size == size
+    reopened.append("d@x.com", {"n": 5})
+    assert as_pairs(reopened.query()) == events + [("d@x.com", {"n": 5})]
+
+
+def test_failed_batch_is_rolled_back(open_log, monkeypatch):
+    log = open_log(fsync=True)
+    events = fill(log, 3)
+    segment_path = log.segments[-1].log_path
+    size = segment_path.stat().st_size
+
+    def fail(fd):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(consent_log.os, "fsync", fail)
+        with pytest.raises(OSError):
+            log.append("a@x.com", {"n": "lost"})
+    assert segment_path.stat().st_size == size
+    log.append("b@x.com", {"n": 3})
+    assert as_pairs(log.query()) == events + [("b@x.com", {"n": 3})]
+
+
+def test_queries_span_segments(open_log):
+    log = open_log(segment_max_bytes=600, index_every_bytes=200)
+    events = fill(log, 60)
+    assert len(log.segments) > 3
+    stored = list(log.query())
+    assert as_pairs(stored) == events
+
+    start, end = stored[15]["ts"], stored[44]["ts"]
+    in_window = [event for event in stored if start <= event["ts"] <= end]
+    assert list(log.query(start=start, end=end)) == in_window
+    assert list(log.query(email="b@x.com", start=start, end=end)) == [
+        event for event in in_window if event["email"] == "b@x.com"
+    ]
+    assert list(log.query(email="b@x.com")) == [e for e in stored if e["email"] == "b@x.com"]
+    assert list(log.query(email="nobody@x.com")) == []
+
+
+def test_instances_sharing_a_directory_see_each_others_writes(open_log):
+    first = open_log(segment_max_bytes=600)
+    second = open_log(segment_max_bytes=600)
+    events = fill(first, 20)
+    assert as_pairs(second.query()) == events
+    second.append("a@x.com", {"n": "second"})
+    events += fill(first, 10)
+    expected = events[:20] + [("a@x.com", {"n": "second"})] + events[20:]
+    assert as_pairs(first.query()) == expected
+    assert as_pairs(second.query()) == expected
+    assert [s.seq for s in first.segments] == [s.seq for s in second.segments]
+
+
+def test_reencrypt_keeps_records_in_place(open_log, key):
+    log = open_log(segment_max_bytes=600, index_every_bytes=200)
+    events = fill(log, 30)
+    sizes = [segment.log_path.stat().st_size for segment in log.segments]
+    index = [read_index(segment) for segment in log.segments]
+
+    new_key = Fernet(Fernet.generate_key())
+    multi = MultiFernet([new_key, key])
+    assert log.reencrypt(multi, new_key) == len(events)
+    assert log.reencrypt(multi, new_key) == 0
+    assert [segment.log_path.stat().st_size for segment in log.segments] == sizes
+    assert [read_index(segment) for segment in log.segments] == index
+
+    log.fernet = new_key
+    assert as_pairs(log.query()) == events
+    start = list(log.query())[10]["ts"]
+    assert as_pairs(log.query(start=start)) == events[10:]
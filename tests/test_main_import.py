@@ -0,0 +1,30 @@
+"""Importing api/main.py stays cheap and has no side effects."""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+PROBE = f"""
+import json, sys
+sys.path.insert(0, {str(API_DIR)!r})
+import main
+print(json.dumps(sorted(name for name in ("cryptography", "jose", "passlib") if name in sys.modules)))
+"""
+
+
+def test_import_loads_no_crypto_and_writes_nothing(tmp_path):
+    env = {
+        key: value for key, value in os.environ.items()
+        if key not in ("SECRET_KEY", "ENCRYPTION_KEY", "ENCRYPTION_KEYS")
+    }
+    env["API_ENV_FILE"] = str(tmp_path / ".env")
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=tmp_path, env=env,
+        capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.splitlines()[-1]) == []
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,74 @@
+"""File store naming and migration (api/storage.py)."""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "api"))
+
+from storage import FileUserStore, SQLiteUserStore, migrate
+
+LEGACY_EMAILS = ["o'brien@x.com", "first last@x.com", "a&b!@x.com", "plain@x.com"]
+
+
+def write_legacy(root, email, blob):
+    """A record as the first file store wrote it: data/users/{email}.json"""
+    root.mkdir(parents=True, exist_ok=True)
+    (root / f"{email}.json").write_bytes(blob)
+
+
+@pytest.mark.parametrize("layout", ["sharded", "flat"])
+@pytest.mark.parametrize("email", LEGACY_EMAILS)
+def test_reads_legacy_raw_file_names(tmp_path, layout, email):
+    write_legacy(tmp_path, email, b"blob")
+    store = FileUserStore(tmp_path, layout=layout, fsync=False)
+    assert store.get(email) == b"blob"
+    assert store.exists(email)
+    assert list(store.iter_emails()) == [email]
+
+
+@pytest.mark.parametrize("layout", ["sharded", "flat"])
+def test_write_and_delete_replace_the_legacy_file(tmp_path, layout):
+    email = "o'brien@x.com"
+    write_legacy(tmp_path, email, b"old")
+    store = FileUserStore(tmp_path, layout=layout, fsync=False)
+    store.put(email, b"new")
+    assert store.get(email) == b"new"
+    assert not (tmp_path / f"{email}.json").exists()
+    assert store.delete(email)
+    assert store.get(email) is None
+
+
+def test_reshard_moves_legacy_files(tmp_path):
+    for email in LEGACY_EMAILS:
+        write_legacy(tmp_path, email, email.encode())
+    store = FileUserStore(tmp_path, fsync=False)
+    assert store.reshard() == {"moved": len(LEGACY_EMAILS), "superseded": 0}
+    assert list(tmp_path.glob("*.json")) == []
+    for email in LEGACY_EMAILS:
+        assert store.get(email) == email.encode()
+
+
+def test_migrate_copies_legacy_files(tmp_path):
+    for email in LEGACY_EMAILS:
+        write_legacy(tmp_path / "users", email, email.encode())
+    source = FileUserStore(tmp_path / "users", fsync=False)
+    dest = SQLiteUserStore(tmp_path / "users.db")
+    unreadable = []
+    try:
+        assert migrate(source, dest, unreadable) == len(LEGACY_EMAILS)
+        assert unreadable == []
+        assert dest.get("o'brien@x.com") == b"o'brien@x.com"
+    finally:
+        dest.close()
+
+
+def test_iter_records_reports_unreadable_emails(tmp_path):
+    store = FileUserStore(tmp_path, fsync=False)
+    store.put("gone@x.com", b"blob")
+    store.put("kept@x.com", b"blob")
+    original_get = store.get
+    store.get = lambda email: None if email == "gone@x.com" else original_get(email)
+    unreadable = []
+    assert [email for email, _ in store.iter_records(unreadable)] == ["kept@x.com"]
+    assert unreadable == ["gone@x.com"]